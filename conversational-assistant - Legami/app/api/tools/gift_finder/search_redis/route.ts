@@ -10,7 +10,36 @@ const sanitize = (t: any, max = 12000) => {
   return s
 }
 
-const toFloat32Buffer = (arr: number[]) => {
+// float32 -> IEEE 754 half precision (Node has no Float16Array)
+const f32Scratch = new Float32Array(1)
+const u32Scratch = new Uint32Array(f32Scratch.buffer)
+const toHalf = (x: number) => {
+  f32Scratch[0] = x
+  const b = u32Scratch[0]
+  const sign = (b >>> 16) & 0x8000
+  const exp = ((b >>> 23) & 0xff) - 112
+  let mant = b & 0x7fffff
+  if (exp >= 31) return sign | 0x7c00
+  if (exp <= 0) {
+    if (exp < -10) return sign
+    mant = (mant | 0x800000) >> (1 - exp)
+    return sign | ((mant + 0x1000) >> 13)
+  }
+  // the rounding carry may overflow the mantissa into the exponent: intended
+  return sign | ((exp << 10) + ((mant + 0x1000) >> 13))
+}
+
+// Query vector in the index vector type (VECTOR_TYPE, same value used by Step 3 load/reindex)
+const toVectorBuffer = (arr: number[], vectorType: string) => {
+  if (vectorType === 'INT8') {
+    // symmetric per-vector quantization like Step 3 (COSINE is scale-invariant)
+    const max = arr.reduce((m, x) => Math.max(m, Math.abs(x)), 0) || 1
+    const i8 = Int8Array.from(arr, x => Math.max(-128, Math.min(127, Math.round((x * 127) / max))))
+    return Buffer.from(i8.buffer)
+  }
+  if (vectorType === 'FLOAT16') {
+    return Buffer.from(Uint16Array.from(arr, toHalf).buffer)
+  }
   const f32 = new Float32Array(arr)
   return Buffer.from(f32.buffer)
 }
@@ -55,7 +84,8 @@ export async function POST(req: Request) {
       input: [expandedQuery],
       dimensions: embDim
     })
-    const vec = toFloat32Buffer(emb.data[0].embedding as unknown as number[])
+    const vectorType = (process.env.VECTOR_TYPE || 'FLOAT32').toUpperCase()
+    const vec = toVectorBuffer(emb.data[0].embedding as unknown as number[], vectorType)
 
     // Enforce a hard cap of 5 results
     const kLimit = Math.min(5, Number(k) || 5)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Helper condivisi dagli script del catalogo (Step 2, Step 3, gift finder agent).
+
+Requisiti:
+  pip install openai "httpx[http2]"
+
+Env (cache embedding delle query, condivisa da Step 3 search e dall'agente):
+  QEMB_PREFIX (qemb:), QEMB_TTL (3600s, 0 = nessuna scadenza), QEMB_CACHE_SIZE (4096)
+"""
+
+import os
+import hashlib
+from typing import Any, Dict
+
+import httpx
+from openai import OpenAI, DefaultHttpxClient
+
+# Cache embedding query: chiave sha256(model|dim|query normalizzata) -> bytes float32.
+# Il formato non dipende da VECTOR_TYPE: la conversione al tipo dell'indice la fa chi legge.
+QEMB_PREFIX     = os.getenv("QEMB_PREFIX", "qemb:")
+QEMB_TTL        = int(os.getenv("QEMB_TTL", "3600"))
+QEMB_CACHE_SIZE = int(os.getenv("QEMB_CACHE_SIZE", "4096"))  # LRU in-process
+
+def make_openai(max_connections: int = 8) -> OpenAI:
+    """Client OpenAI con pool keep-alive condiviso tra i worker
+    (HTTP/2 multiplexing se `h2` è installato: pip install "httpx[http2]")."""
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+    http = DefaultHttpxClient(
+        http2=http2,
+        limits=httpx.Limits(max_connections=max_connections,
+                            max_keepalive_connections=max(1, max_connections // 2)),
+        timeout=httpx.Timeout(60.0, connect=10.0),
+    )
+    return OpenAI(http_client=http)
+
+def normalize_query(text: Any) -> str:
+    return " ".join(str(text).casefold().split())
+
+def qemb_key(model: str, dim: int, query_text: Any) -> str:
+    """Chiave Redis della cache query: la normalizzazione vale solo per la chiave,
+    all'API va sempre il testo originale."""
+    text_norm = normalize_query(query_text)
+    return QEMB_PREFIX + hashlib.sha256(f"{model}|{dim}|{text_norm}".encode("utf-8")).hexdigest()
+
+def qemb_store(r: Any, key: str, raw: bytes):
+    """Scrive un embedding float32 in cache (client Redis o pipeline); QEMB_TTL=0 -> senza scadenza."""
+    if QEMB_TTL > 0:
+        r.setex(key, QEMB_TTL, raw)
+    else:
+        r.set(key, raw)
+
+def index_vector_info(r: Any, index_name: str) -> Dict[str, str]:
+    """algorithm/data_type del campo embedding da FT.INFO ({} se l'indice non esiste)."""
+    from redis.exceptions import ResponseError
+    try:
+        info = r.ft(index_name).info()
+    except ResponseError:
+        return {}
+    for attr in info.get("attributes") or []:
+        vals = [a.decode() if isinstance(a, bytes) else str(a) for a in attr]
+        d = {vals[i].lower(): vals[i + 1] for i in range(0, len(vals) - 1, 2)}
+        if "embedding" in (d.get("identifier"), d.get("attribute")):
+            return {"algorithm": d.get("algorithm", "").upper(), "data_type": d.get("data_type", "").upper()}
+    return {}
@@ -8,7 +8,7 @@ gift_finder_agent.py — agente "find-gift" che:
 - NON inventa prodotti: tutto ciò che propone viene dal tool
 
 Requisiti:
-  pip install openai redis numpy
+  pip install openai redis numpy orjson
 
 Env:
   OPENAI_API_KEY=...
@@ -16,25 +16,36 @@ Env:
   INDEX_NAME=idx:products
   EMBED_MODEL=text-embedding-3-large
   EMBED_DIM=1024
-  # opz: JSON_PREFIX, VEC_PREFIX, LLM_MODEL
+  VECTOR_TYPE=FLOAT32   # oppure FLOAT16 / INT8 (indice quantizzato, Redis 8+)
+  # opz: JSON_PREFIX, VEC_PREFIX, LLM_MODEL, EF_RUNTIME (64)
+  # opz cache embedding query (condivisa con Step 3 search): QEMB_PREFIX (qemb:), QEMB_TTL (3600s, 0 = nessuna scadenza), QEMB_CACHE_SIZE (4096)
+  # opz cache ricerche per sessione: SEARCH_CACHE_SIZE (32)
+  # opz OPENAI_KEEPALIVE=30: ping /v1/models ogni N secondi per tenere calda la connessione (0 = off)
 
 Esecuzione:
-  python gift_finder_agent.py --session ./session_chat.json
+  python gift_finder_agent.py --session ./session_chat.jsonl
   (comandi: /reset, /quit)
 """
 
 import os
-import re
 import json
+import base64
 import time
+import hashlib
 import argparse
+import functools
+import threading
+from collections import OrderedDict
 from typing import Any, Dict, List, Optional
 import numpy as np
+import orjson
 import redis
 
 from openai import OpenAI, APIError, APIConnectionError, RateLimitError, BadRequestError
 from redis.commands.search.query import Query
 
+from catalog_common import index_vector_info, qemb_key, qemb_store, QEMB_CACHE_SIZE
+
 # -----------------------------
 # Config
 # -----------------------------
@@ -46,14 +57,19 @@ VEC_PREFIX  = os.getenv("VEC_PREFIX", "vec:")
 EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-large")
 EMBED_DIM   = int(os.getenv("EMBED_DIM", "1024"))
 LLM_MODEL   = os.getenv("LLM_MODEL", "gpt-4o-mini-2024-07-18")
+# Tipo vettore dell'indice (--vector-type di Step 3): FLOAT32 | FLOAT16 | INT8; usato solo se FT.INFO non lo riporta
+VECTOR_TYPE = os.getenv("VECTOR_TYPE", "FLOAT32").upper()
+EF_RUNTIME  = int(os.getenv("EF_RUNTIME", "64"))  # HNSW: candidati esplorati per query
+
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "32"))  # risultati search_redis memorizzati per sessione
+OPENAI_KEEPALIVE = float(os.getenv("OPENAI_KEEPALIVE", "0"))   # secondi tra due ping a connessione inattiva
 
 # -----------------------------
 # Utils
 # -----------------------------
 def sanitize_for_embedding(text: Any, max_chars: int = 12000) -> str:
     s = "" if text is None else str(text)
-    s = s.replace("\x00", " ")
-    s = re.sub(r"\s+", " ", s).strip()
+    s = " ".join(s.replace("\x00", " ").split())
     if len(s) > max_chars:
         s = s[:max_chars]
     if not s:
@@ -70,50 +86,154 @@ def with_backoff(fn, *, retries: int = 5, base_delay: float = 1.2):
             time.sleep(min(30.0, base_delay * (2 ** i)))
     return fn()
 
-def to_bytes(vec: np.ndarray) -> bytes:
-    return np.asarray(vec, dtype=np.float32).tobytes()
+def to_bytes(vec: np.ndarray, vector_type: str = VECTOR_TYPE) -> bytes:
+    v = np.asarray(vec, dtype=np.float32)
+    if vector_type == "INT8":
+        # quantizzazione simmetrica per-vettore: la distanza COSINE è invariante alla scala
+        max_abs = float(np.max(np.abs(v))) or 1.0
+        return np.clip(np.round(v * (127.0 / max_abs)), -128, 127).astype(np.int8).tobytes()
+    if vector_type == "FLOAT16":
+        return v.astype(np.float16).tobytes()
+    return v.tobytes()
+
+# Caratteri speciali della query syntax RediSearch da escapare nei filtri TAG
+_TAG_SPECIALS = frozenset(r""" \,.<>{}[]"':;!@#$%^&*()-+=~|/""")
 
 def _escape_tag(s: str) -> str:
-    return s.replace(" ", "\\ ")
+    return "".join("\\" + c if c in _TAG_SPECIALS else c for c in str(s))
 
-def _b(x):
-    return x.decode() if isinstance(x, (bytes, bytearray)) else x
+# Campi di default restituiti nei dettagli prodotto (ordine stabile -> payload deterministica)
+_DEFAULT_WANTED = (
+    "id","title","description","category","brand","ean","upc","themes",
+    "material","material_secondary","made_in","format","binding",
+    "dimensions","canonical_text","keywords","topics","attributes_extracted"
+)
 
 def pick_product_fields(j: Dict[str, Any], wanted: Optional[List[str]] = None) -> Dict[str, Any]:
     """Ritorna un sottoinsieme utile del JSON prodotto per non esagerare con la payload size."""
     if not j:
         return {}
-    if not wanted:
-        wanted = [
-            "id","title","description","category","brand","ean","upc","themes",
-            "material","material_secondary","made_in","format","binding",
-            "dimensions","canonical_text","keywords","topics","attributes_extracted"
-        ]
-    out = {}
-    for k in wanted:
-        if k in j:
-            out[k] = j[k]
-    return out
+    return {k: j[k] for k in (wanted or _DEFAULT_WANTED) if k in j}
+
+_OPENAI: Optional[OpenAI] = None
+
+def get_openai() -> OpenAI:
+    """Client OpenAI condiviso (un solo pool HTTP keep-alive per embeddings + chat).
+    Retry gestiti da with_backoff, quindi max_retries=0 lato SDK."""
+    global _OPENAI
+    if _OPENAI is None:
+        _OPENAI = OpenAI(timeout=30.0, max_retries=0)
+    return _OPENAI
+
+def start_keepalive(client: OpenAI, interval: float) -> threading.Event:
+    """Ping leggero (GET /v1/models) ogni `interval` secondi mentre l'utente scrive:
+    la connessione TLS resta aperta e il turno successivo non paga handshake/cold start."""
+    stop = threading.Event()
+
+    def _loop():
+        while not stop.wait(interval):
+            try:
+                client.models.list()
+            except Exception:
+                pass
+
+    threading.Thread(target=_loop, name="openai-keepalive", daemon=True).start()
+    return stop
 
 # -----------------------------
 # Redis Tooling
 # -----------------------------
+@functools.lru_cache(maxsize=128)
+def _mk_query(fexpr: str, k: int, hnsw: bool = True) -> Query:
+    """Query KNN per (filtro, k): riusata tra i turni, il vettore arriva come parametro.
+    EF_RUNTIME solo su indici HNSW (un indice FLAT non migrato con reindex lo rifiuta)."""
+    ef = " EF_RUNTIME $ef" if hnsw else ""
+    return (
+        Query(f"({fexpr})=>[KNN {k} @embedding $vec{ef} AS score]")
+        .sort_by("score")
+        .paging(0, k)
+        .return_fields("code","title","brand","category","score")
+        .dialect(2)
+    )
+
 class RedisToolbox:
     def __init__(self, redis_url: str, index_name: str):
         self.r = redis.from_url(redis_url, decode_responses=False)
+        # client testuale dedicato a FT.SEARCH: campi già decodificati, niente decode per riga
+        self.r_txt = redis.from_url(redis_url, decode_responses=True)
         self.index_name = index_name
-        self.client = OpenAI()
-
-    # Embedding query
+        self.client = get_openai()
+        self._embed_cache: "OrderedDict[str, bytes]" = OrderedDict()
+        self._embed_lock = threading.Lock()
+        self._vinfo: Dict[str, str] = {}
+
+    def _vector_info(self) -> Dict[str, str]:
+        # letto da FT.INFO una volta sola; se l'indice non esiste ancora si riprova alla search successiva
+        if not self._vinfo:
+            self._vinfo = index_vector_info(self.r_txt, self.index_name)
+        return self._vinfo
+
+    def _is_hnsw(self) -> bool:
+        return self._vector_info().get("algorithm") == "HNSW"
+
+    def _vector_type(self) -> str:
+        # il tipo dichiarato dall'indice prevale su VECTOR_TYPE: un env sbagliato non produce un blob illeggibile
+        return self._vector_info().get("data_type") or VECTOR_TYPE
+
+    def _cache_put(self, key: str, vec: bytes):
+        with self._embed_lock:
+            self._embed_cache[key] = vec
+            self._embed_cache.move_to_end(key)
+            while len(self._embed_cache) > QEMB_CACHE_SIZE:
+                self._embed_cache.popitem(last=False)
+
+    # Embedding query (cache locale -> Redis -> OpenAI)
     def _embed_query(self, query: str) -> bytes:
-        query = sanitize_for_embedding(query)
-        def _call():
-            res = self.client.embeddings.create(
-                model=EMBED_MODEL, input=[query], dimensions=EMBED_DIM
-            )
-            v = np.array(res.data[0].embedding, dtype=np.float32)
-            return to_bytes(v)
-        return with_backoff(_call)
+        return self.embed_queries([query])[0]
+
+    # Embedding di più query: i miss di cache vanno in UNA sola chiamata embeddings.
+    # In cache (qemb:, condivisa con Step 3) restano i float32; la conversione al tipo dell'indice avviene qui.
+    def embed_queries(self, queries: List[str]) -> List[bytes]:
+        queries = [sanitize_for_embedding(q) for q in queries]
+        keys = [qemb_key(EMBED_MODEL, EMBED_DIM, q) for q in queries]
+        found: Dict[str, bytes] = {}
+
+        with self._embed_lock:
+            for key in keys:
+                vec = self._embed_cache.get(key)
+                if vec is not None:
+                    self._embed_cache.move_to_end(key)
+                    found[key] = vec
+
+        miss = list(dict.fromkeys(k for k in keys if k not in found))
+        if miss:
+            rvals = self.r.mget(miss)
+            for key, vec in zip(miss, rvals):
+                if vec is not None and len(vec) == EMBED_DIM * 4:
+                    self._cache_put(key, vec)
+                    found[key] = vec
+
+        miss = [k for k in miss if k not in found]
+        if miss:
+            texts = [queries[keys.index(k)] for k in miss]
+            def _call():
+                # base64: il payload è già float32 little-endian, niente liste di float Python
+                res = self.client.embeddings.create(
+                    model=EMBED_MODEL, input=texts, dimensions=EMBED_DIM, encoding_format="base64"
+                )
+                return [base64.b64decode(d.embedding) for d in res.data]
+            vecs = with_backoff(_call)
+            pipe = self.r.pipeline(transaction=False)
+            for key, vec in zip(miss, vecs):
+                qemb_store(pipe, key, vec)
+                self._cache_put(key, vec)
+                found[key] = vec
+            pipe.execute()
+
+        vector_type = self._vector_type()
+        if vector_type == "FLOAT32":
+            return [found[k] for k in keys]
+        return [to_bytes(np.frombuffer(found[k], dtype=np.float32), vector_type) for k in keys]
 
     # Search KNN + filtri, con DETTAGLI (full JSON ridotto) incorporati
     def search(self,
@@ -131,9 +251,9 @@ class RedisToolbox:
 
         parts = []
         if category:
-            parts.append(f'@category:{{{category}}}')
+            parts.append(f'@category:{{{_escape_tag(category)}}}')
         if brand:
-            parts.append(f'@brand:{{{brand}}}')
+            parts.append(f'@brand:{{{_escape_tag(brand)}}}')
         if must_keywords:
             safe = [_escape_tag(k) for k in must_keywords]
             parts.append(f'@keywords:{{{"|".join(safe)}}}')
@@ -143,30 +263,32 @@ class RedisToolbox:
             parts.append(f'@price:[{lo} {hi}]')
         fexpr = " ".join(parts) if parts else "*"
 
-        q = (
-            Query(f"({fexpr})=>[KNN {k} @embedding $vec AS score]")
-            .sort_by("score")
-            .paging(0, k)
-            .return_fields("code","title","brand","category","keywords","score")
-            .dialect(2)
-        )
-        res = self.r.ft(self.index_name).search(q, query_params={"vec": qvec})
+        hnsw = self._is_hnsw()
+        q = _mk_query(fexpr, k, hnsw)
+        params = {"vec": qvec, "ef": max(EF_RUNTIME, k)} if hnsw else {"vec": qvec}
+        res = self.r_txt.ft(self.index_name).search(q, query_params=params)
 
         items = []
         for d in res.docs:
-            code = _b(d.code)
+            code = d.code
             row = {
                 "code": code,
-                "title": _b(d.title),
-                "brand": _b(d.brand) if hasattr(d, "brand") else None,
-                "category": _b(d.category) if hasattr(d, "category") else None,
+                "title": getattr(d, "title", None),
+                "brand": getattr(d, "brand", None),
+                "category": getattr(d, "category", None),
                 "score": float(d.score),
             }
-            if include_details:
-                j = self.r.json().get(f"{JSON_PREFIX}{code}") or {}
-                row["product"] = pick_product_fields(j, detail_fields)
             items.append(row)
 
+        if include_details and items:
+            # un solo round-trip per tutti i JSON.GET dei risultati
+            pipe = self.r.pipeline(transaction=False)
+            for row in items:
+                pipe.execute_command("JSON.GET", f"{JSON_PREFIX}{row['code']}")
+            for row, raw in zip(items, pipe.execute()):
+                j = orjson.loads(raw) if raw else {}
+                row["product"] = pick_product_fields(j, detail_fields)
+
         return {
             "count": res.total,
             "k": k,
@@ -183,10 +305,10 @@ class RedisToolbox:
         if title:
             phrase = title.replace('"', '\\"')
             q = Query(f'@title:"{phrase}"').paging(0, 5).return_fields("code","title").dialect(2)
-            res = self.r.ft(self.index_name).search(q)
+            res = self.r_txt.ft(self.index_name).search(q)
             if res.docs:
                 d = res.docs[0]
-                code = _b(d.code)
+                code = d.code
                 j = self.r.json().get(f"{JSON_PREFIX}{code}") or {}
                 return {"found": True, "by": "title", "code": code, "product": j}
         return {"found": False, "error": "missing code/title or not found"}
@@ -246,85 +368,168 @@ def tools_schema() -> List[Dict[str, Any]]:
         }
     ]
 
+# Schema dei tool costruito una sola volta: identico per ogni turno/round
+TOOLS_SCHEMA = tools_schema()
+
 class GiftFinderAgent:
     def __init__(self, session_path: Optional[str] = None):
-        self.client = OpenAI()
+        self.client = get_openai()
         self.redis = RedisToolbox(REDIS_URL, INDEX_NAME)
         self.messages: List[Dict[str, Any]] = [{"role": "system", "content": SYSTEM_PROMPT}]
         self.session_path = session_path
         self._last_search = None
         self._active_code = None
+        self._search_cache: "OrderedDict[bytes, Any]" = OrderedDict()  # args search_redis -> (result, json)
+        self._persisted_len = 0  # messaggi (esclusa la system) già scritti su disco
         self._load_session()
 
     # ---- persistence ----
+    # Sessione in JSONL append-only: un messaggio (non-system) per riga.
+    # Ogni turno aggiunge solo i messaggi nuovi; il file viene riscritto solo su reset()
+    # (o per migrare il vecchio formato {"messages": [...]} / scartare righe troncate).
     def _load_session(self):
-        if self.session_path and os.path.exists(self.session_path):
-            try:
-                with open(self.session_path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                msgs = data.get("messages")
-                if isinstance(msgs, list) and msgs:
-                    self.messages = [self.messages[0]] + [m for m in msgs if m.get("role") != "system"]
-            except Exception:
-                pass
-
-    def _save_session(self):
+        if not (self.session_path and os.path.exists(self.session_path)):
+            return
+        try:
+            with open(self.session_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return
+        try:
+            doc = orjson.loads(data)
+        except ValueError:
+            doc = None  # JSONL su più righe (o con una riga troncata)
+        msgs: List[Any] = []
+        compact = False
+        if isinstance(doc, dict) and "messages" in doc:
+            # vecchio formato {"messages": [...]}, indentato o su una riga
+            msgs = doc["messages"] if isinstance(doc["messages"], list) else []
+            compact = True
+        else:
+            for line in data.splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    msgs.append(orjson.loads(line))
+                except ValueError:
+                    compact = True  # riga troncata (es. crash durante la scrittura)
+        valid = [m for m in msgs if isinstance(m, dict) and "role" in m]
+        compact = compact or len(valid) != len(msgs)  # righe che non sono messaggi: si riscrive il file
+        msgs = [m for m in valid if m["role"] != "system"]
+        if msgs:
+            self.messages = [self.messages[0]] + msgs
+        self._persisted_len = len(msgs)
+        if compact:
+            self._rewrite_session()
+
+    def _rewrite_session(self):
         if not self.session_path:
             return
-        data = {"messages": [m for m in self.messages if m["role"] != "system"]}
         tmp = self.session_path + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        msgs = [m for m in self.messages if m["role"] != "system"]
+        with open(tmp, "wb") as f:
+            for m in msgs:
+                f.write(orjson.dumps(m) + b"\n")
         os.replace(tmp, self.session_path)
+        self._persisted_len = len(msgs)
+
+    def _save_session(self):
+        if not self.session_path:
+            return
+        new = [m for m in self.messages[1 + self._persisted_len:] if m["role"] != "system"]
+        if not new:
+            return
+        with open(self.session_path, "ab") as f:
+            for m in new:
+                f.write(orjson.dumps(m) + b"\n")
+        self._persisted_len += len(new)
 
     # ---- tool dispatcher ----
+    @staticmethod
+    def _search_params(args: Dict[str, Any]) -> Dict[str, Any]:
+        return dict(
+            query_text=args.get("query_text",""),
+            k=int(args.get("k", 8)),
+            category=args.get("category"),
+            brand=args.get("brand"),
+            must_keywords=args.get("must_keywords"),
+            min_price=args.get("min_price"),
+            max_price=args.get("max_price"),
+            include_details = bool(args.get("include_details", True)),
+            detail_fields  = args.get("detail_fields")
+        )
+
+    @staticmethod
+    def _search_key(params: Dict[str, Any]) -> bytes:
+        return hashlib.sha1(json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8")).digest()
+
+    def _prefetch_search_embeddings(self, tool_calls) -> None:
+        """Più search_redis nello stesso turno: embedding di tutte le query in una sola chiamata."""
+        queries = []
+        for tc in tool_calls:
+            if tc.function.name != "search_redis":
+                continue
+            try:
+                params = self._search_params(orjson.loads(tc.function.arguments or "{}"))
+            except Exception:
+                continue
+            if self._search_key(params) not in self._search_cache:
+                queries.append(params["query_text"])
+        if len(queries) > 1:
+            try:
+                self.redis.embed_queries(queries)
+            except Exception:
+                pass  # fallback: ogni search calcola il proprio embedding
+
     def _dispatch_tool(self, name: str, arguments: str) -> str:
         try:
-            args = json.loads(arguments or "{}")
+            args = orjson.loads(arguments or "{}")
         except Exception:
             args = {}
 
         if name == "search_redis":
-            result = self.redis.search(
-                query_text=args.get("query_text",""),
-                k=int(args.get("k", 8)),
-                category=args.get("category"),
-                brand=args.get("brand"),
-                must_keywords=args.get("must_keywords"),
-                min_price=args.get("min_price"),
-                max_price=args.get("max_price"),
-                include_details = bool(args.get("include_details", True)),
-                detail_fields  = args.get("detail_fields")
-            )
+            params = self._search_params(args)
+            # stessa ricerca (query + filtri) già eseguita: niente embedding né KNN
+            key = self._search_key(params)
+            cached = self._search_cache.get(key)
+            if cached is not None:
+                self._search_cache.move_to_end(key)
+                result, out = cached
+            else:
+                result = self.redis.search(**params)
+                out = orjson.dumps(result).decode()
+                self._search_cache[key] = (result, out)
+                if len(self._search_cache) > SEARCH_CACHE_SIZE:
+                    self._search_cache.popitem(last=False)
             self._last_search = result
             if result.get("items"):
                 self._active_code = result["items"][0]["code"]  # default “focus” sul primo
-            return json.dumps(result, ensure_ascii=False)
+            return out
 
         if name == "get_product":
             code = args.get("code")
             title = args.get("title")
             if not code and not title:
-                return json.dumps({"found": False, "error": "missing code or title"}, ensure_ascii=False)
+                return orjson.dumps({"found": False, "error": "missing code or title"}).decode()
             result = self.redis.get_product(code=code, title=title)
             if result.get("found") and result.get("code"):
                 self._active_code = result["code"]
-            return json.dumps(result, ensure_ascii=False)
+            return orjson.dumps(result).decode()
 
-        return json.dumps({"error": f"Unknown tool {name}"})
+        return orjson.dumps({"error": f"Unknown tool {name}"}).decode()
 
     # ---- chat loop ----
     def ask(self, user_text: str) -> str:
         self.messages.append({"role": "user", "content": user_text})
 
         while True:
-            resp = self.client.chat.completions.create(
+            resp = with_backoff(lambda: self.client.chat.completions.create(
                 model=LLM_MODEL,
                 messages=self.messages,
-                tools=tools_schema(),
+                tools=TOOLS_SCHEMA,
                 tool_choice="auto",
                 temperature=0.3,
-            )
+            ))
             msg = resp.choices[0].message
 
             if msg.tool_calls:
@@ -333,6 +538,7 @@ class GiftFinderAgent:
                     "content": None,
                     "tool_calls": [tc.model_dump() for tc in msg.tool_calls]
                 })
+                self._prefetch_search_embeddings(msg.tool_calls)
                 for tc in msg.tool_calls:
                     out = self._dispatch_tool(tc.function.name, tc.function.arguments)
                     self.messages.append({
@@ -352,17 +558,20 @@ class GiftFinderAgent:
         self.messages = [{"role": "system", "content": SYSTEM_PROMPT}]
         self._last_search = None
         self._active_code = None
-        self._save_session()
+        self._search_cache.clear()
+        self._rewrite_session()
 
 # -----------------------------
 # REPL
 # -----------------------------
 def main():
     ap = argparse.ArgumentParser(description="GiftFinder Agent (search returns details)")
-    ap.add_argument("--session", help="Path file JSON per salvare la conversazione", default=None)
+    ap.add_argument("--session", help="Path file JSONL per salvare la conversazione (un messaggio per riga)", default=None)
     args = ap.parse_args()
 
     agent = GiftFinderAgent(session_path=args.session)
+    if OPENAI_KEEPALIVE > 0:
+        start_keepalive(agent.client, OPENAI_KEEPALIVE)
     print("🎁 GiftFinder pronto. Scrivi la tua richiesta (digita /reset per azzerare, /quit per uscire).\n")
 
     while True:
@@ -18,15 +18,20 @@ Uso:
 
 Se preferisci un array JSON:
     python sfcc_xml_to_json.py --xml ./catalog.xml --out ./prodotti.json --format json
+
+La normalizzazione dei prodotti usa tutti i core (--workers N, default: numero di CPU; --workers 1 per la modalità seriale).
 """
 
+import os
 import argparse
 import json
 import sys
 import html
 import re
 import hashlib
-from typing import Dict, Any, List, Optional
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Deque, Dict, Any, Iterable, Iterator, List, Optional
 from lxml import etree
 
 # Namespace SFCC + xml:lang
@@ -38,14 +43,16 @@ NS = {
 # ---------- Utilità di pulizia testo ----------
 
 TAG_RE = re.compile(r"<[^>]+>")
+_WS = re.compile(r"\s+")
+_HAS_MARKUP = re.compile(r"[<&]")
 
 def strip_html(x: Optional[str]) -> str:
     if not x:
         return ""
-    s = html.unescape(x)
-    s = TAG_RE.sub(" ", s)
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
+    # fast-path: niente tag/entità -> solo normalizzazione whitespace
+    if not _HAS_MARKUP.search(x):
+        return _WS.sub(" ", x).strip()
+    return _WS.sub(" ", TAG_RE.sub(" ", html.unescape(x))).strip()
 
 def to_bool(s: Optional[str]) -> Optional[bool]:
     if s is None:
@@ -92,124 +99,194 @@ def pick_localized(elems: List[etree._Element], lang_priority: List[str]) -> str
 
 # ---------- Parser principale ----------
 
+# XPath precompilate (namespace risolti una volta sola, riusate per ogni prodotto)
+_XP_DISPLAY    = etree.XPath("dwc:display-name", namespaces=NS)
+_XP_SHORT      = etree.XPath("dwc:short-description", namespaces=NS)
+_XP_LONG       = etree.XPath("dwc:long-description", namespaces=NS)
+_XP_CUSTOM     = etree.XPath(".//dwc:custom-attributes/dwc:custom-attribute", namespaces=NS)
+_XP_EAN        = etree.XPath("dwc:ean", namespaces=NS)
+_XP_UPC        = etree.XPath("dwc:upc", namespaces=NS)
+_XP_ONLINE     = etree.XPath("dwc:online-flag", namespaces=NS)
+_XP_AVAILABLE  = etree.XPath("dwc:available-flag", namespaces=NS)
+_XP_SEARCHABLE = etree.XPath("dwc:searchable-flag", namespaces=NS)
+_XP_TAX_CLASS  = etree.XPath("dwc:tax-class-id", namespaces=NS)
+
+def product_to_dict(p: etree._Element, lang_priority: List[str]) -> Dict[str, Any]:
+    # Localizzati
+    display_all = _XP_DISPLAY(p)
+    short_all   = _XP_SHORT(p)
+    long_all    = _XP_LONG(p)
+
+    # ID prodotto
+    pid = p.get("product-id")
+    if not pid:
+        # fallback: se non presente, prova id interno o genera hash deterministico
+        # (in SFCC normalmente c'è product-id)
+        title_tmp = pick_localized(display_all, lang_priority) or pick_localized(short_all, lang_priority) or pick_localized(long_all, lang_priority)
+        basis = (title_tmp or "")[:80]
+        pid = hashlib.blake2b(basis.encode("utf-8"), digest_size=16).hexdigest()
+
+    title = pick_localized(display_all, lang_priority)
+    short_desc = pick_localized(short_all, lang_priority)
+    long_desc  = pick_localized(long_all, lang_priority)
+    description = long_desc or short_desc
+
+    # Se il title è vuoto, prova a derivarlo dalla descrizione
+    if not title:
+        title = (description[:120] + "…") if len(description) > 120 else description
+
+    # Custom attributes: mappa attribute-id -> {lang: value}
+    custom_attrs: Dict[str, Dict[str, str]] = {}
+    for ca in _XP_CUSTOM(p):
+        attr_id = ca.get("attribute-id")
+        if not attr_id:
+            continue
+        lang = (ca.get(f"{{{NS['xml']}}}lang") or "x-default").lower()
+        val = strip_html(ca.text or "")
+        # registra solo se c'è un valore non vuoto
+        if val:
+            custom_attrs.setdefault(attr_id, {})
+            # se il lang esiste già e siamo in conflitto, mantieni il primo non vuoto
+            if lang not in custom_attrs[attr_id]:
+                custom_attrs[attr_id][lang] = val
+
+    # Campi base
+    ean_el = _XP_EAN(p)
+    upc_el = _XP_UPC(p)
+    ean = strip_html((ean_el[0].text if ean_el else None) or "")
+    upc = strip_html((upc_el[0].text if upc_el else None) or "")
+
+    # Flag e tassazione
+    # Attenzione: in alcuni XML certe flag possono comparire duplicate: prendiamo la prima significativa
+    def first_text(xp: etree.XPath) -> Optional[str]:
+        for el in xp(p):
+            txt = strip_html(el.text or "")
+            if txt != "":
+                return txt
+        return None
+
+    online_flag      = to_bool(first_text(_XP_ONLINE))
+    available_flag   = to_bool(first_text(_XP_AVAILABLE))
+    searchable_flag  = to_bool(first_text(_XP_SEARCHABLE))
+    tax_class        = strip_html(first_text(_XP_TAX_CLASS) or "")
+
+    # Derivati da custom-attributes con priorità di lingua
+    category   = safe_first(custom_attrs, "tipologia", lang_priority)
+    if not category:
+        category = safe_first(custom_attrs, "serieMerceologica", lang_priority) or safe_first(custom_attrs, "eventoCommerciale", lang_priority)
+
+    themes     = safe_first(custom_attrs, "temi", lang_priority)
+    made_in    = safe_first(custom_attrs, "made_in", lang_priority)
+    material   = safe_first(custom_attrs, "materiale", lang_priority)
+    material2  = safe_first(custom_attrs, "materialeSecondario", lang_priority)
+    formato    = safe_first(custom_attrs, "formato", lang_priority)
+    binding    = safe_first(custom_attrs, "rilegatura", lang_priority)
+
+    dim_w      = safe_first(custom_attrs, "dimWidth", lang_priority)
+    dim_h      = safe_first(custom_attrs, "dimHeight", lang_priority)
+    dim_d      = safe_first(custom_attrs, "dimDepth", lang_priority)
+    dim_weight = safe_first(custom_attrs, "dimWeight", lang_priority)
+
+    # Brand: se fisso (es. Legami), puoi valorizzarlo qui; altrimenti lascia vuoto
+    brand = ""
+
+    prod: Dict[str, Any] = {
+        "id": pid,
+        "title": title or "",
+        "description": description or "",
+        "category": category or "",
+        "brand": brand,
+        "ean": ean,
+        "upc": upc,
+        "themes": themes or "",
+        "material": material or "",
+        "material_secondary": material2 or "",
+        "made_in": made_in or "",
+        "format": formato or "",
+        "binding": binding or "",
+        "online": online_flag,
+        "available": available_flag,
+        "searchable": searchable_flag,
+        "tax_class": tax_class or "",
+        "dimensions": {
+            "width": dim_w or "",
+            "height": dim_h or "",
+            "depth": dim_d or "",
+            "weight_g": dim_weight or ""
+        },
+        # Manteniamo tutti i custom attributes multi-lingua per usi futuri (estrazione keyword, tassonomia, ecc.)
+        "custom_attributes": custom_attrs
+    }
+
+    return prod
+
+def _iter_product_elements(xml_path: str) -> Iterator[etree._Element]:
+    """Parsing in streaming: un <product> alla volta, memoria costante anche su cataloghi multi-GB."""
+    context = etree.iterparse(
+        xml_path, events=("end",), tag=f"{{{NS['dwc']}}}product",
+        remove_blank_text=True, recover=True, huge_tree=True, encoding="utf-8"
+    )
+    for _, p in context:
+        yield p
+        # libera il sottoalbero già elaborato (e i fratelli precedenti: header, categorie, ...)
+        p.clear()
+        while p.getprevious() is not None:
+            del p.getparent()[0]
+    del context
+
+def iter_products(xml_path: str, lang_priority: List[str]) -> Iterator[Dict[str, Any]]:
+    for p in _iter_product_elements(xml_path):
+        yield product_to_dict(p, lang_priority)
+
+def _normalize_chunk(chunk: List[bytes], lang_priority: List[str]) -> List[Dict[str, Any]]:
+    # eseguito nei processi worker: ri-parsa il frammento <product> serializzato
+    return [product_to_dict(etree.fromstring(b), lang_priority) for b in chunk]
+
+def iter_products_parallel(xml_path: str, lang_priority: List[str],
+                           workers: int, chunk_size: int = 500) -> Iterator[Dict[str, Any]]:
+    """Come iter_products, ma la normalizzazione (CPU-bound) gira su più processi.
+    Il main process fa solo iterparse + tostring; l'ordine di output è preservato."""
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        inflight: Deque[Future] = deque()
+        chunk: List[bytes] = []
+        for p in _iter_product_elements(xml_path):
+            chunk.append(etree.tostring(p, with_tail=False))
+            if len(chunk) >= chunk_size:
+                inflight.append(ex.submit(_normalize_chunk, chunk, lang_priority))
+                chunk = []
+                # limita i chunk in volo per mantenere la memoria costante
+                while len(inflight) > workers * 2:
+                    yield from inflight.popleft().result()
+        if chunk:
+            inflight.append(ex.submit(_normalize_chunk, chunk, lang_priority))
+        while inflight:
+            yield from inflight.popleft().result()
+
 def parse_sfcc(xml_path: str, lang_priority: List[str]) -> List[Dict[str, Any]]:
-    parser = etree.XMLParser(remove_blank_text=True, recover=True, encoding="utf-8")
-    tree = etree.parse(xml_path, parser)
-    root = tree.getroot()
-
-    products: List[Dict[str, Any]] = []
-
-    for p in root.findall(".//dwc:product", namespaces=NS):
-        # ID prodotto
-        pid = p.get("product-id")
-        if not pid:
-            # fallback: se non presente, prova id interno o genera hash deterministico
-            # (in SFCC normalmente c'è product-id)
-            dn_all = p.findall("dwc:display-name", namespaces=NS)
-            ld_all = p.findall("dwc:long-description", namespaces=NS)
-            sd_all = p.findall("dwc:short-description", namespaces=NS)
-            title_tmp = pick_localized(dn_all, lang_priority) or pick_localized(sd_all, lang_priority) or pick_localized(ld_all, lang_priority)
-            basis = (title_tmp or "")[:80]
-            pid = hashlib.md5(basis.encode("utf-8")).hexdigest()
-
-        # Localizzati
-        display_all = p.findall("dwc:display-name", namespaces=NS)
-        short_all   = p.findall("dwc:short-description", namespaces=NS)
-        long_all    = p.findall("dwc:long-description", namespaces=NS)
-
-        title = pick_localized(display_all, lang_priority)
-        short_desc = pick_localized(short_all, lang_priority)
-        long_desc  = pick_localized(long_all, lang_priority)
-        description = long_desc or short_desc
-
-        # Se il title è vuoto, prova a derivarlo dalla descrizione
-        if not title:
-            title = (description[:120] + "…") if len(description) > 120 else description
-
-        # Custom attributes: mappa attribute-id -> {lang: value}
-        custom_attrs: Dict[str, Dict[str, str]] = {}
-        for ca in p.findall(".//dwc:custom-attributes/dwc:custom-attribute", namespaces=NS):
-            attr_id = ca.get("attribute-id")
-            if not attr_id:
-                continue
-            lang = (ca.get(f"{{{NS['xml']}}}lang") or "x-default").lower()
-            val = strip_html(ca.text or "")
-            # registra solo se c'è un valore non vuoto
-            if val:
-                custom_attrs.setdefault(attr_id, {})
-                # se il lang esiste già e siamo in conflitto, mantieni il primo non vuoto
-                if lang not in custom_attrs[attr_id]:
-                    custom_attrs[attr_id][lang] = val
-
-        # Campi base
-        ean = strip_html((p.findtext("dwc:ean", namespaces=NS) or ""))
-        upc = strip_html((p.findtext("dwc:upc", namespaces=NS) or ""))
-
-        # Flag e tassazione
-        # Attenzione: in alcuni XML certe flag possono comparire duplicate: prendiamo la prima significativa
-        def first_text(tag: str) -> Optional[str]:
-            for el in p.findall(f"dwc:{tag}", namespaces=NS):
-                txt = strip_html(el.text or "")
-                if txt != "":
-                    return txt
-            return None
-
-        online_flag      = to_bool(first_text("online-flag"))
-        available_flag   = to_bool(first_text("available-flag"))
-        searchable_flag  = to_bool(first_text("searchable-flag"))
-        tax_class        = strip_html(first_text("tax-class-id") or "")
-
-        # Derivati da custom-attributes con priorità di lingua
-        category   = safe_first(custom_attrs, "tipologia", lang_priority)
-        if not category:
-            category = safe_first(custom_attrs, "serieMerceologica", lang_priority) or safe_first(custom_attrs, "eventoCommerciale", lang_priority)
-
-        themes     = safe_first(custom_attrs, "temi", lang_priority)
-        made_in    = safe_first(custom_attrs, "made_in", lang_priority)
-        material   = safe_first(custom_attrs, "materiale", lang_priority)
-        material2  = safe_first(custom_attrs, "materialeSecondario", lang_priority)
-        formato    = safe_first(custom_attrs, "formato", lang_priority)
-        binding    = safe_first(custom_attrs, "rilegatura", lang_priority)
-
-        dim_w      = safe_first(custom_attrs, "dimWidth", lang_priority)
-        dim_h      = safe_first(custom_attrs, "dimHeight", lang_priority)
-        dim_d      = safe_first(custom_attrs, "dimDepth", lang_priority)
-        dim_weight = safe_first(custom_attrs, "dimWeight", lang_priority)
-
-        # Brand: se fisso (es. Legami), puoi valorizzarlo qui; altrimenti lascia vuoto
-        brand = ""
-
-        prod: Dict[str, Any] = {
-            "id": pid,
-            "title": title or "",
-            "description": description or "",
-            "category": category or "",
-            "brand": brand,
-            "ean": ean,
-            "upc": upc,
-            "themes": themes or "",
-            "material": material or "",
-            "material_secondary": material2 or "",
-            "made_in": made_in or "",
-            "format": formato or "",
-            "binding": binding or "",
-            "online": online_flag,
-            "available": available_flag,
-            "searchable": searchable_flag,
-            "tax_class": tax_class or "",
-            "dimensions": {
-                "width": dim_w or "",
-                "height": dim_h or "",
-                "depth": dim_d or "",
-                "weight_g": dim_weight or ""
-            },
-            # Manteniamo tutti i custom attributes multi-lingua per usi futuri (estrazione keyword, tassonomia, ecc.)
-            "custom_attributes": custom_attrs
-        }
-
-        products.append(prod)
-
-    return products
+    return list(iter_products(xml_path, lang_priority))
+
+# ---------- Output (streaming) ----------
+
+def write_jsonl(f, products: Iterable[Dict[str, Any]]) -> int:
+    n = 0
+    for p in products:
+        f.write(json.dumps(p, ensure_ascii=False) + "\n")
+        n += 1
+    return n
+
+def write_json_array(f, products: Iterable[Dict[str, Any]], pretty: bool) -> int:
+    """Scrive un array JSON elemento per elemento (output identico a json.dump)."""
+    n = 0
+    f.write("[")
+    for p in products:
+        if pretty:
+            body = json.dumps(p, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+            f.write((",\n  " if n else "\n  ") + body)
+        else:
+            f.write((", " if n else "") + json.dumps(p, ensure_ascii=False))
+        n += 1
+    f.write("\n]" if (pretty and n) else "]")
+    return n
 
 # ---------- CLI ----------
 
@@ -221,22 +298,24 @@ def main():
     ap.add_argument("--lang", nargs="+", default=["it", "en", "x-default", "es", "fr", "de"],
                     help="Priorità di lingue per i campi localizzati (default: it en x-default es fr de)")
     ap.add_argument("--pretty", action="store_true", help="Pretty print (solo per formato json)")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                    help="Processi per la normalizzazione prodotti (default: numero di CPU; 1 = seriale)")
+    ap.add_argument("--chunk-size", type=int, default=500,
+                    help="Prodotti per chunk inviato ai worker (default: 500)")
     args = ap.parse_args()
 
-    products = parse_sfcc(args.xml, args.lang)
-
-    if args.format == "jsonl":
-        with open(args.out, "w", encoding="utf-8") as f:
-            for p in products:
-                f.write(json.dumps(p, ensure_ascii=False) + "\n")
+    if args.workers > 1:
+        products = iter_products_parallel(args.xml, args.lang, args.workers, args.chunk_size)
     else:
-        with open(args.out, "w", encoding="utf-8") as f:
-            if args.pretty:
-                json.dump(products, f, ensure_ascii=False, indent=2)
-            else:
-                json.dump(products, f, ensure_ascii=False)
+        products = iter_products(args.xml, args.lang)
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        if args.format == "jsonl":
+            n = write_jsonl(f, products)
+        else:
+            n = write_json_array(f, products, pretty=args.pretty)
 
-    print(f"[DONE] Prodotti esportati: {len(products)} → {args.out}")
+    print(f"[DONE] Prodotti esportati: {n} → {args.out}")
 
 if __name__ == "__main__":
     main()
@@ -3,13 +3,17 @@
 """
 Step 2 (parallel): Semantic enrichment with OpenAI
 - Forces EN output (keywords/topics/attributes/occasions/audience/negatives + canonical_summary_en)
-- Parallel OpenAI calls (concurrency configurable)
-- Chat Completions + JSON Schema (Structured Outputs)
-- Single embeddings call per product for keyword re-scoring
+- Parallel OpenAI calls (concurrency configurable) under optional RPM/TPM limits (--llm-rpm/--llm-tpm, --embed-rpm/--embed-tpm)
+- Chat Completions + JSON Schema (Structured Outputs), several products per request (--llm-batch-size)
+- Batched embeddings calls for keyword re-scoring (up to --embed-batch-size products per request);
+  --skip-short-rescore skips it (and --min-sim) when candidates fit in --topk, --local-rerank re-scores on CPU
 - Optional canonical_text embedding (debug/small sets)
+- Persistent SQLite cache of LLM extractions and embeddings (--cache-path, --no-cache)
+- Offline mode via the OpenAI Batch API (--offline-batch): 50% cheaper, up to 24h latency
 
 Usage:
-  pip install openai numpy
+  pip install openai numpy orjson ijson "httpx[http2]"
+  pip install fastembed   # optional, only for --local-rerank
   export OPENAI_API_KEY=sk-...
 
   python step2_extract_keywords_openai.py \
@@ -22,29 +26,39 @@ Usage:
     --topk 16 \
     --min-sim 0.25 \
     --concurrency 6 \
+    --llm-batch-size 12 \
+    --embed-batch-size 128 \
     --target-lang en
 """
 
 import os
 import re
 import json
+import base64
 import time
+import hashlib
+import sqlite3
 import argparse
-from typing import Dict, Any, List, Iterable, Optional
+import functools
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, Any, List, Iterable, Optional, Callable, Tuple
+import ijson
 import numpy as np
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import orjson
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from openai import OpenAI, APIError, APIConnectionError, RateLimitError, BadRequestError
+from catalog_common import make_openai
 
 # -----------------------------
 # Text utilities
 # -----------------------------
-WS_RE = re.compile(r"\s+")
-TRAIL_PUNCT_RE = re.compile(r"^[\s,.;:!?]+|[\s,.;:!?]+$")
+EDGE_PUNCT = " ,.;:!?"
 
 def clean_token(s: str) -> str:
-    t = TRAIL_PUNCT_RE.sub("", WS_RE.sub(" ", str(s))).strip().lower()
-    return t
+    # str.split()/join collapse whitespace in C (same char set as regex \s), no regex pass
+    return " ".join(str(s).split()).strip(EDGE_PUNCT).lower()
 
 def clean_list(xs: Iterable[str]) -> List[str]:
     out, seen = [], set()
@@ -55,10 +69,12 @@ def clean_list(xs: Iterable[str]) -> List[str]:
             out.append(t)
     return out
 
+_MEASURE_RE = re.compile(r"^\s*(\d+(?:[.,]\d+)?)\s*[xX]\s*(\d+(?:[.,]\d+)?)(?:\s*cm)?\s*$")
+
 def shorten_measure(s: str) -> str:
     if not s:
         return s
-    m = re.match(r"^\s*(\d+(?:[.,]\d+)?)\s*[xX]\s*(\d+(?:[.,]\d+)?)(?:\s*cm)?\s*$", s.strip())
+    m = _MEASURE_RE.match(s.strip())
     if m:
         a, b = m.group(1).replace(",", "."), m.group(2).replace(",", ".")
         return f"{a} x {b} cm"
@@ -72,25 +88,39 @@ def read_jsonl(path: str) -> Iterable[Dict[str, Any]]:
         for line in f:
             line = line.strip()
             if line:
-                yield json.loads(line)
+                yield orjson.loads(line)
 
 def read_json_array(path: str) -> Iterable[Dict[str, Any]]:
-    with open(path, "r", encoding="utf-8") as f:
-        arr = json.load(f)
-    for obj in arr:
-        yield obj
+    # streaming: one object at a time instead of json.load on the whole array
+    with open(path, "rb") as f:
+        yield from ijson.items(f, "item", use_float=True)
 
 def write_jsonl_stream(path: str, objs: Iterable[Dict[str, Any]]):
-    with open(path, "w", encoding="utf-8") as f:
+    with open(path, "wb") as f:
         for o in objs:
-            f.write(json.dumps(o, ensure_ascii=False) + "\n")
+            f.write(orjson.dumps(o))
+            f.write(b"\n")
+
+class JsonArrayWriter:
+    """Writes a JSON array one element at a time with orjson (compact, or indent=2 like json.dump)."""
+
+    def __init__(self, path: str, pretty: bool):
+        self.f = open(path, "wb")
+        self.pretty = pretty
+        self.n = 0
+        self.f.write(b"[")
 
-def write_json_array(path: str, objs: List[Dict[str, Any]], pretty: bool):
-    with open(path, "w", encoding="utf-8") as f:
-        if pretty:
-            json.dump(objs, f, ensure_ascii=False, indent=2)
+    def write(self, o: Dict[str, Any]):
+        if self.pretty:
+            body = orjson.dumps(o, option=orjson.OPT_INDENT_2).replace(b"\n", b"\n  ")
+            self.f.write((b",\n  " if self.n else b"\n  ") + body)
         else:
-            json.dump(objs, f, ensure_ascii=False)
+            self.f.write((b"," if self.n else b"") + orjson.dumps(o))
+        self.n += 1
+
+    def close(self):
+        self.f.write(b"\n]" if (self.pretty and self.n) else b"]")
+        self.f.close()
 
 # -----------------------------
 # Backoff
@@ -106,6 +136,104 @@ def with_backoff(fn, *, retries: int = 5, base_delay: float = 1.2):
             time.sleep(min(30.0, sleep))
     return fn()
 
+class RateLimiter:
+    """Thread-safe sliding-window limiter (60s) on requests and tokens per minute; 0 disables a limit.
+    Workers block in acquire() instead of firing requests that would come back as 429."""
+
+    def __init__(self, rpm: int = 0, tpm: int = 0):
+        self.configure(rpm, tpm)
+        self._events: deque = deque()   # (monotonic ts, tokens)
+        self._tokens = 0
+        self._lock = threading.Lock()
+
+    def configure(self, rpm: int, tpm: int):
+        self.rpm, self.tpm = max(0, rpm), max(0, tpm)
+
+    def acquire(self, tokens: int = 0):
+        if not self.rpm and not self.tpm:
+            return
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._events and now - self._events[0][0] >= 60.0:
+                    self._tokens -= self._events.popleft()[1]
+                if (not self.rpm or len(self._events) < self.rpm) and \
+                   (not self.tpm or self._tokens + tokens <= self.tpm):
+                    self._events.append((now, tokens))
+                    self._tokens += tokens
+                    return
+                delay = 60.0 - (now - self._events[0][0])
+            time.sleep(max(0.01, delay))
+
+# One limiter per model family (limits are per model); configured from CLI in main()
+chat_limiter = RateLimiter()
+embed_limiter = RateLimiter()
+CHAT_OUTPUT_TOKENS_EST = 350   # expected completion tokens per extracted product
+
+def _est_tokens(*texts: str) -> int:
+    return sum(len(t) for t in texts) // 4 + 1
+
+# -----------------------------
+# Persistent LLM extraction cache (SQLite, exact match)
+# -----------------------------
+class ExtractionCache:
+    """On-disk cache of cleaned extraction results keyed by SHA-256(text+model+prompt+schema+lang),
+    plus float32 embeddings keyed by SHA-256(model|dim|text).
+    Reruns and identical product texts skip the Chat Completions / embeddings calls entirely."""
+
+    def __init__(self, path: str, ttl_days: float):
+        self.ttl_s = int(ttl_days * 86400)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (hash TEXT PRIMARY KEY, payload TEXT NOT NULL, ts INTEGER NOT NULL)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS emb_cache (hash BLOB PRIMARY KEY, vec BLOB NOT NULL)")
+
+    @staticmethod
+    def key(**parts: Any) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT payload, ts FROM llm_cache WHERE hash = ?", (key,)).fetchone()
+        if row is None or (self.ttl_s > 0 and time.time() - row[1] > self.ttl_s):
+            return None
+        return orjson.loads(row[0])
+
+    def put(self, key: str, payload: Dict[str, Any]):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO llm_cache (hash, payload, ts) VALUES (?, ?, ?)",
+                (key, orjson.dumps(payload).decode("utf-8"), int(time.time()))
+            )
+
+    def get_vectors(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        found: Dict[bytes, np.ndarray] = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT hash, vec FROM emb_cache WHERE hash IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for k, v in rows:
+                    found[bytes(k)] = np.frombuffer(v, dtype=np.float32)
+        return found
+
+    def put_vectors(self, items: Dict[bytes, np.ndarray]):
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO emb_cache (hash, vec) VALUES (?, ?)",
+                [(k, np.asarray(v, dtype=np.float32).tobytes()) for k, v in items.items()]
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
 # -----------------------------
 # Build product context (source can be IT/ES/etc.)
 # -----------------------------
@@ -148,30 +276,55 @@ def build_product_text(prod: Dict[str, Any]) -> str:
 # -----------------------------
 # LLM extraction (Chat Completions + JSON Schema), forced English
 # -----------------------------
-def extract_llm_fields(client: OpenAI, model: str, text: str, target_lang: str = "en") -> Dict[str, Any]:
+def _resolve_llm_model(model: str) -> str:
     model = os.getenv("OPENAI_LLM_MODEL", model) or model
     if model == "gpt-4o-mini":
         model = "gpt-4o-mini-2024-07-18"
+    return model
+
+# Built once and shared by every request (treat as read-only): identical prompt prefixes
+# across calls are also what makes OpenAI's automatic prompt caching kick in.
+KEYWORDS_SCHEMA: Dict[str, Any] = {
+    "name": "ProductKeywords",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "keyphrases": {"type": "array", "items": {"type": "string"}},
+            "topics": {"type": "array", "items": {"type": "string"}},
+            "attributes": {"type": "array", "items": {"type": "string"}},
+            "occasions": {"type": "array", "items": {"type": "string"}},
+            "audience": {"type": "array", "items": {"type": "string"}},
+            "negatives": {"type": "array", "items": {"type": "string"}},
+            "canonical_summary_en": {"type": "string"}
+        },
+        "required": ["keyphrases","topics","attributes","occasions","audience","negatives","canonical_summary_en"],
+        "additionalProperties": False
+    }
+}
 
-    schema = {
-        "name": "ProductKeywords",
+@functools.lru_cache(maxsize=64)
+def _keywords_batch_schema(n: int) -> Dict[str, Any]:
+    base = KEYWORDS_SCHEMA["schema"]
+    item = {
+        **base,
+        "properties": {"index": {"type": "integer"}, **base["properties"]},
+        "required": ["index"] + base["required"],
+    }
+    return {
+        "name": "ProductKeywordsBatch",
         "schema": {
             "type": "object",
             "properties": {
-                "keyphrases": {"type": "array", "items": {"type": "string"}},
-                "topics": {"type": "array", "items": {"type": "string"}},
-                "attributes": {"type": "array", "items": {"type": "string"}},
-                "occasions": {"type": "array", "items": {"type": "string"}},
-                "audience": {"type": "array", "items": {"type": "string"}},
-                "negatives": {"type": "array", "items": {"type": "string"}},
-                "canonical_summary_en": {"type": "string"}
+                "items": {"type": "array", "items": item, "minItems": n, "maxItems": n}
             },
-            "required": ["keyphrases","topics","attributes","occasions","audience","negatives","canonical_summary_en"],
+            "required": ["items"],
             "additionalProperties": False
         }
     }
 
-    sys = (
+@functools.lru_cache(maxsize=8)
+def _system_prompt(target_lang: str) -> str:
+    return (
         "You are a product keyword extractor and normalizer. "
         "Always respond in ENGLISH ({lang}), even if the input is in another language. "
         "Return ONLY valid JSON following the provided schema. "
@@ -179,76 +332,240 @@ def extract_llm_fields(client: OpenAI, model: str, text: str, target_lang: str =
         "avoid brand names unless clearly part of the product name; use neutral consumer terminology."
     ).format(lang=target_lang)
 
+_STRIP = ",.;:!?"
+
+def _clean(xs):
+    out, seen = [], set()
+    for x in xs or []:
+        s = " ".join(str(x).split()).strip(_STRIP).lower()
+        if len(s) >= 2 and s not in seen:
+            seen.add(s); out.append(s)
+    return out
+
+def _clean_fields(data: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "keyphrases": _clean(data.get("keyphrases", [])),
+        "topics": _clean(data.get("topics", [])),
+        "attributes": _clean(data.get("attributes", [])),
+        "occasions": _clean(data.get("occasions", [])),
+        "audience": _clean(data.get("audience", [])),
+        "negatives": _clean(data.get("negatives", [])),
+        "canonical_summary_en": (data.get("canonical_summary_en") or "").strip()
+    }
+
+FIELDS_MEMO_MAX = 20000      # in-memory extractions kept across groups (works with --no-cache too)
+
+_fields_memo: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_fields_memo_lock = threading.Lock()
+
+def _remember_fields(key: str, fields: Dict[str, Any]):
+    # stored as soon as known: a per-product retry after a failure does not re-extract the others
+    with _fields_memo_lock:
+        _fields_memo[key] = fields
+        while len(_fields_memo) > FIELDS_MEMO_MAX:
+            _fields_memo.popitem(last=False)
+
+def _cache_key(text: str, model: str, target_lang: str) -> str:
+    # same key for single and batched calls: results are interchangeable
+    return ExtractionCache.key(text=text, model=model, sys=_system_prompt(target_lang),
+                               schema=KEYWORDS_SCHEMA, lang=target_lang)
+
+def _extraction_body(model: str, text: str, target_lang: str) -> Dict[str, Any]:
+    """Chat Completions params for one product (shared by the sync path and the Batch API)."""
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": _system_prompt(target_lang)},
+            {"role": "user", "content": f"Product text:\n{text}\n\nExtract the required fields in English."}
+        ],
+        "response_format": {"type": "json_schema", "json_schema": KEYWORDS_SCHEMA},
+        "temperature": 0.0
+    }
+
+def extract_llm_fields(client: OpenAI, model: str, text: str, target_lang: str = "en",
+                       cache: Optional[ExtractionCache] = None) -> Dict[str, Any]:
+    model = _resolve_llm_model(model)
+    body = _extraction_body(model, text, target_lang)
+
+    est = _est_tokens(body["messages"][0]["content"], body["messages"][1]["content"]) + CHAT_OUTPUT_TOKENS_EST
+
     def _call():
-        resp = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": sys},
-                {"role": "user", "content": f"Product text:\n{text}\n\nExtract the required fields in English."}
-            ],
-            response_format={"type": "json_schema", "json_schema": schema},
-            temperature=0.0
-        )
+        chat_limiter.acquire(est)
+        resp = client.chat.completions.create(**body)
         raw = resp.choices[0].message.content
-        data = json.loads(raw)
-
-        def _clean(xs):
-            out, seen = [], set()
-            for x in xs or []:
-                s = re.sub(r"\s+", " ", str(x)).strip().strip(",.;:!?").lower()
-                if len(s) >= 2 and s not in seen:
-                    seen.add(s); out.append(s)
-            return out
-
-        return {
-            "keyphrases": _clean(data.get("keyphrases", [])),
-            "topics": _clean(data.get("topics", [])),
-            "attributes": _clean(data.get("attributes", [])),
-            "occasions": _clean(data.get("occasions", [])),
-            "audience": _clean(data.get("audience", [])),
-            "negatives": _clean(data.get("negatives", [])),
-            "canonical_summary_en": (data.get("canonical_summary_en") or "").strip()
-        }
+        return _clean_fields(orjson.loads(raw))
 
-    return with_backoff(_call)
+    if cache is None:
+        return with_backoff(_call)
+    key = _cache_key(text, model, target_lang)
+    hit = cache.get(key)
+    if hit is not None:
+        return hit
+    fields = with_backoff(_call)
+    cache.put(key, fields)
+    return fields
+
+def extract_llm_fields_batch(client: OpenAI, model: str, texts: List[str], target_lang: str = "en",
+                             cache: Optional[ExtractionCache] = None) -> List[Dict[str, Any]]:
+    """Extracts fields for several products with ONE Chat Completion (array schema, aligned by index).
+    Items missing from the model answer fall back to a single-product call."""
+    model = _resolve_llm_model(model)
+    out: List[Optional[Dict[str, Any]]] = [None] * len(texts)
+    keys = [_cache_key(t, model, target_lang) for t in texts]
+    with _fields_memo_lock:
+        for i, key in enumerate(keys):
+            out[i] = _fields_memo.get(key)
+    if cache is not None:
+        for i, key in enumerate(keys):
+            if out[i] is None:
+                out[i] = cache.get(key)
+
+    # identical texts (color/size variants) are extracted once, then broadcast
+    first: Dict[str, int] = {}
+    for i, r in enumerate(out):
+        if r is None:
+            first.setdefault(keys[i], i)
+    todo = list(first.values())
+    if len(todo) == 1:
+        out[todo[0]] = extract_llm_fields(client, model, texts[todo[0]], target_lang, cache)
+        _remember_fields(keys[todo[0]], out[todo[0]])
+        todo = []
+    if todo:
+        schema = _keywords_batch_schema(len(todo))
+        sys = _system_prompt(target_lang)
+        listing = "\n\n".join(f"[[{j}]] {texts[i]}" for j, i in enumerate(todo))
+        user = (f"Products ({len(todo)}):\n\n{listing}\n\n"
+                "Extract the required fields in English for EACH product: one item per product, "
+                "with `index` equal to the number in its [[n]] marker.")
+
+        est = _est_tokens(sys, user) + CHAT_OUTPUT_TOKENS_EST * len(todo)
+
+        def _call():
+            chat_limiter.acquire(est)
+            resp = client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": sys},
+                    {"role": "user", "content": user}
+                ],
+                response_format={"type": "json_schema", "json_schema": schema},
+                temperature=0.0
+            )
+            return orjson.loads(resp.choices[0].message.content).get("items") or []
+
+        try:
+            items = with_backoff(_call)
+        except (BadRequestError, ValueError):
+            # rejected group (e.g. content policy, context overflow) or truncated answer:
+            # every product goes through the single-product fallback below
+            items = []
+        for data in items:
+            j = data.get("index") if isinstance(data, dict) else None
+            if isinstance(j, int) and 0 <= j < len(todo) and out[todo[j]] is None:
+                i = todo[j]
+                out[i] = _clean_fields(data)
+                _remember_fields(keys[i], out[i])
+                if cache is not None:
+                    cache.put(keys[i], out[i])
+
+        for i in todo:
+            if out[i] is None:
+                out[i] = extract_llm_fields(client, model, texts[i], target_lang, cache)
+                _remember_fields(keys[i], out[i])
+
+    for i, r in enumerate(out):
+        if r is None:
+            out[i] = out[first[keys[i]]]
+    return out
 
 # -----------------------------
 # Embeddings + cosine re-scoring
-# (single call: [doc_text] + candidates)
+# (batched: [doc_text] + candidates for many products per request)
 # -----------------------------
+EMBED_MAX_INPUTS = 2048      # max inputs accepted by a single embeddings request
+EMBED_CACHE_MAX = 20000      # in-memory vectors kept across batches/retries
+
+_embed_cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+_embed_cache_lock = threading.Lock()
+
 def embed_openai(client: OpenAI, model: str, dim: int, texts: List[str]) -> np.ndarray:
     if not texts:
         return np.zeros((0, dim), dtype=np.float32)
+    est = _est_tokens(*texts)
+
     def _call():
-        res = client.embeddings.create(model=model, input=texts, dimensions=dim)
-        vecs = np.array([d.embedding for d in res.data], dtype=np.float32)
+        embed_limiter.acquire(est)
+        # base64: smaller payload, decoded straight into a preallocated float32 matrix
+        res = client.embeddings.create(model=model, input=texts, dimensions=dim, encoding_format="base64")
+        vecs = np.empty((len(res.data), dim), dtype=np.float32)
+        for i, d in enumerate(res.data):
+            vecs[i] = np.frombuffer(base64.b64decode(d.embedding), dtype=np.float32)
         return vecs
     return with_backoff(_call)
 
-def cosine(a: np.ndarray, b: np.ndarray) -> np.ndarray:
-    if a.size == 0 or b.size == 0:
-        return np.zeros((a.shape[0], b.shape[0]), dtype=np.float32)
-    a = a / (np.linalg.norm(a, axis=1, keepdims=True) + 1e-12)
-    b = b / (np.linalg.norm(b, axis=1, keepdims=True) + 1e-12)
-    return a @ b.T
-
-def rescore_keywords_single_call(client: OpenAI,
-                                 embed_model: str,
-                                 embed_dim: int,
-                                 product_base_text: str,
-                                 candidates: List[str],
-                                 top_k: int,
-                                 min_sim: float) -> List[str]:
-    if not candidates:
+def _text_key(model: str, dim: int, text: str) -> bytes:
+    return hashlib.sha256(f"{model}|{dim}|{text}".encode("utf-8")).digest()
+
+def embed_with_cache(client: OpenAI, model: str, dim: int, texts: List[str],
+                     cache: Optional[ExtractionCache] = None) -> np.ndarray:
+    """Embeds texts in as few requests as possible, skipping duplicates and already-seen texts
+    (in-memory LRU first, then the on-disk cache when given)."""
+    if not texts:
+        return np.zeros((0, dim), dtype=np.float32)
+    keys = [_text_key(model, dim, t) for t in texts]
+
+    found: Dict[bytes, np.ndarray] = {}
+    with _embed_cache_lock:
+        for k in keys:
+            v = _embed_cache.get(k)
+            if v is not None:
+                found[k] = v
+
+    missing: Dict[bytes, str] = {}
+    for k, t in zip(keys, texts):
+        if k not in found and k not in missing:
+            missing[k] = t
+
+    if missing:
+        miss_keys = list(missing)
+        if cache is not None:
+            found.update(cache.get_vectors(miss_keys))
+        api_keys = [k for k in miss_keys if k not in found]
+        api_texts = [missing[k] for k in api_keys]
+        for start in range(0, len(api_texts), EMBED_MAX_INPUTS):
+            vecs = embed_openai(client, model, dim, api_texts[start:start + EMBED_MAX_INPUTS])
+            for k, v in zip(api_keys[start:start + EMBED_MAX_INPUTS], vecs):
+                found[k] = v
+        if cache is not None and api_keys:
+            cache.put_vectors({k: found[k] for k in api_keys})
+        with _embed_cache_lock:
+            for k in miss_keys:
+                _embed_cache[k] = found[k]
+            while len(_embed_cache) > EMBED_CACHE_MAX:
+                _embed_cache.popitem(last=False)
+
+    return np.vstack([found[k] for k in keys])
+
+def l2_normalize(a: np.ndarray) -> np.ndarray:
+    # row norms via einsum: no [N,D] temporary for the squares
+    return a * (1.0 / (np.sqrt(np.einsum("ij,ij->i", a, a)) + 1e-12))[:, None]
+
+def rescore_keywords(doc_vec: np.ndarray,
+                     cand_vecs: np.ndarray,
+                     candidates: List[str],
+                     top_k: int,
+                     min_sim: float) -> List[str]:
+    """Ranks candidates by cosine vs the doc; expects L2-normalized vectors ([1,D] and [N,D])."""
+    if not candidates or top_k <= 0:
         return []
-    inputs = [product_base_text] + candidates
-    vecs = embed_openai(client, embed_model, embed_dim, inputs)  # [1+N, D]
-    doc_vec = vecs[0:1, :]                                      # [1,D]
-    cand_vecs = vecs[1:, :]                                     # [N,D]
-    sims = cosine(cand_vecs, doc_vec).flatten()                  # [N]
-    ranked = sorted(zip(candidates, sims), key=lambda x: x[1], reverse=True)
-    filtered = [k for k, s in ranked if s >= min_sim]
-    return (filtered[:top_k] or [k for k, _ in ranked[:min(top_k, len(ranked))]])
+    sims = cand_vecs @ doc_vec[0]                                # [N], single SGEMV
+    idx = np.flatnonzero(sims >= min_sim)
+    if idx.size == 0:
+        idx = np.arange(sims.shape[0])
+    if idx.size > top_k:
+        idx = idx[np.argpartition(-sims[idx], top_k - 1)[:top_k]]
+    idx = idx[np.argsort(-sims[idx], kind="stable")]
+    return [candidates[i] for i in idx]
 
 # -----------------------------
 # Canonical text (English)
@@ -273,40 +590,37 @@ def canonical_text_en(canonical_summary_en: str,
 
 # -----------------------------
 # Per-product pipeline (thread-safe)
+# Phase 1: LLM extraction per product
+# Phase 2: one embeddings call per batch of products + local re-scoring
 # -----------------------------
-def enrich_product(client: OpenAI,
-                   llm_model: str,
-                   embed_model: str,
-                   embed_dim: int,
-                   prod: Dict[str, Any],
-                   topk: int,
-                   min_sim: float,
-                   include_embedding: bool,
-                   target_lang: str) -> Dict[str, Any]:
+def extract_products(client: OpenAI,
+                     llm_model: str,
+                     prods: List[Dict[str, Any]],
+                     target_lang: str,
+                     cache: Optional[ExtractionCache] = None) -> List[Dict[str, Any]]:
     # 1) Context
-    text = build_product_text(prod)
-
-    # 2) LLM extraction (EN)
-    fields = extract_llm_fields(client, llm_model, text, target_lang=target_lang)
-
-    # 3) Re-score keywords with single embeddings call
-    base_for_rescore = ". ".join([t for t in [
-        prod.get("title") or "",
-        prod.get("brand") or "",
-        prod.get("category") or "",
-        prod.get("themes") or "",
-        shorten_measure(prod.get("format") or ""),
-        prod.get("binding") or "",
-        prod.get("material") or "",
-        prod.get("description") or ""
-    ] if t])
-    keyphrases = rescore_keywords_single_call(
-        client, embed_model, embed_dim, base_for_rescore, fields["keyphrases"], topk, min_sim
-    )
-
-    # 4) Canonical text EN
-    canon = canonical_text_en(fields.get("canonical_summary_en", ""), keyphrases, fields["topics"], fields["attributes"])
+    texts = [build_product_text(prod) for prod in prods]
+
+    # 2) LLM extraction (EN), one Chat Completion for the whole group
+    all_fields = extract_llm_fields_batch(client, llm_model, texts, target_lang=target_lang, cache=cache)
+
+    # 3) Base text for keyword re-scoring
+    return [{"prod": prod, "fields": fields, "base": base}
+            for prod, fields, base in zip(prods, all_fields, bases_for_rescore(prods))]
+
+RESCORE_FIELDS = ("title", "brand", "category", "themes", "format", "binding", "material", "description")
 
+def bases_for_rescore(prods: List[Dict[str, Any]]) -> List[str]:
+    """Base texts for keyword re-scoring, built column by column (one pass per field, one join per product)."""
+    cols = [[p.get(k) or "" for p in prods] for k in RESCORE_FIELDS]
+    cols[RESCORE_FIELDS.index("format")] = [shorten_measure(f) for f in cols[RESCORE_FIELDS.index("format")]]
+    return [". ".join([t for t in row if t]) for row in zip(*cols)]
+
+def finalize_enriched(prod: Dict[str, Any],
+                      fields: Dict[str, Any],
+                      keyphrases: List[str],
+                      embed_model: str,
+                      embed_dim: int) -> Dict[str, Any]:
     enriched = dict(prod)
     enriched["keywords"] = keyphrases
     enriched["topics"] = fields["topics"]
@@ -314,16 +628,243 @@ def enrich_product(client: OpenAI,
     enriched["occasions"] = fields["occasions"]
     enriched["audience"] = fields["audience"]
     enriched["negatives"] = fields["negatives"]
-    enriched["canonical_text"] = canon
+    enriched["canonical_text"] = canonical_text_en(fields.get("canonical_summary_en", ""), keyphrases,
+                                                   fields["topics"], fields["attributes"])
     enriched["embedding_model"] = embed_model
     enriched["embedding_dimensions"] = embed_dim
+    return enriched
+
+_local_models: Dict[str, Any] = {}
+_local_models_lock = threading.Lock()
+
+def embed_local(model_name: str, texts: List[str]) -> np.ndarray:
+    """CPU embeddings with fastembed (optional dependency), used only for --local-rerank."""
+    with _local_models_lock:
+        model = _local_models.get(model_name)
+        if model is None:
+            from fastembed import TextEmbedding
+            model = _local_models[model_name] = TextEmbedding(model_name)
+    if not texts:
+        return np.zeros((0, 1), dtype=np.float32)
+    return np.asarray(list(model.embed(texts)), dtype=np.float32)
+
+def needs_api_rescore(candidates: List[str], topk: int, local_rerank: Optional[str],
+                      skip_short: bool = False) -> bool:
+    # no candidates: nothing to rank, the [base] text is not embedded at all
+    # skip_short (opt-in): candidates that fit in --topk keep the LLM order, unfiltered by --min-sim
+    return bool(candidates) and not local_rerank and (not skip_short or len(candidates) > topk)
+
+def rescore_items(client: OpenAI,
+                  embed_model: str,
+                  embed_dim: int,
+                  extracted: List[Dict[str, Any]],
+                  topk: int,
+                  min_sim: float,
+                  cache: Optional[ExtractionCache] = None,
+                  local_rerank: Optional[str] = None,
+                  skip_short: bool = False) -> List[List[str]]:
+    """Final keyphrases per item: one embeddings call (API or local model) for the whole batch."""
+    inputs: List[str] = []
+    offsets: List[Optional[int]] = []
+    for item in extracted:
+        candidates = item["fields"]["keyphrases"]
+        if candidates and (local_rerank or needs_api_rescore(candidates, topk, local_rerank, skip_short)):
+            offsets.append(len(inputs))
+            inputs.append(item["base"])
+            inputs.extend(candidates)
+        else:
+            offsets.append(None)
+    if local_rerank:
+        vecs = l2_normalize(embed_local(local_rerank, inputs))
+    elif inputs:
+        vecs = l2_normalize(embed_with_cache(client, embed_model, embed_dim, inputs, cache))
+
+    out: List[List[str]] = []
+    for item, off in zip(extracted, offsets):
+        candidates = item["fields"]["keyphrases"]
+        if off is None:
+            out.append(candidates[:topk])
+            continue
+        doc_vec = vecs[off:off + 1, :]                               # [1,D]
+        cand_vecs = vecs[off + 1:off + 1 + len(candidates), :]       # [N,D]
+        out.append(rescore_keywords(doc_vec, cand_vecs, candidates, topk, min_sim))
+    return out
+
+def enrich_batch(client: OpenAI,
+                 embed_model: str,
+                 embed_dim: int,
+                 extracted: List[Dict[str, Any]],
+                 topk: int,
+                 min_sim: float,
+                 include_embedding: bool,
+                 cache: Optional[ExtractionCache] = None,
+                 local_rerank: Optional[str] = None,
+                 skip_short: bool = False) -> List[Dict[str, Any]]:
+    # 1) Single embeddings call for all [base] + candidates of the batch, 2) re-score + canonical text EN
+    all_kws = rescore_items(client, embed_model, embed_dim, extracted, topk, min_sim, cache, local_rerank,
+                            skip_short)
+    out = [finalize_enriched(item["prod"], item["fields"], kws, embed_model, embed_dim)
+           for item, kws in zip(extracted, all_kws)]
 
     if include_embedding:
         # optional extra call (kept separate to not inflate the joint call above)
-        vec = embed_openai(client, embed_model, embed_dim, [canon])[0]
+        add_canonical_embeddings(client, embed_model, embed_dim, out, cache)
+
+    return out
+
+def add_canonical_embeddings(client: OpenAI, embed_model: str, embed_dim: int, objs: List[Dict[str, Any]],
+                             cache: Optional[ExtractionCache] = None):
+    canon_vecs = embed_with_cache(client, embed_model, embed_dim, [e["canonical_text"] for e in objs], cache)
+    for enriched, vec in zip(objs, canon_vecs):
         enriched["embedding"] = [float(x) for x in vec.tolist()]
 
-    return enriched
+# -----------------------------
+# Offline mode: OpenAI Batch API (/v1/chat/completions, then /v1/embeddings)
+# Same request bodies as the sync path; results reassembled by custom_id.
+# -----------------------------
+BATCH_MAX_INPUTS = 50000     # max requests (and embedding inputs) per batch
+BATCH_POLL_SECONDS = 30
+BATCH_FINAL_STATES = ("completed", "failed", "expired", "cancelled")
+
+def build_batch_jsonl(url: str, bodies: Dict[str, Dict[str, Any]]) -> bytes:
+    return b"".join(orjson.dumps({"custom_id": cid, "method": "POST", "url": url, "body": body}) + b"\n"
+                    for cid, body in bodies.items())
+
+def _batch_chunks(bodies: Dict[str, Dict[str, Any]]) -> Iterable[Dict[str, Dict[str, Any]]]:
+    chunk: Dict[str, Dict[str, Any]] = {}
+    weight = 0
+    for cid, body in bodies.items():
+        w = len(body["input"]) if isinstance(body.get("input"), list) else 1
+        if chunk and weight + w > BATCH_MAX_INPUTS:
+            yield chunk
+            chunk, weight = {}, 0
+        chunk[cid] = body
+        weight += w
+    if chunk:
+        yield chunk
+
+def run_openai_batch(client: OpenAI,
+                     url: str,
+                     bodies: Dict[str, Dict[str, Any]],
+                     on_result: Callable[[str, Dict[str, Any]], None],
+                     poll_seconds: float = BATCH_POLL_SECONDS):
+    """Submits `bodies` (custom_id -> request body) and calls on_result(custom_id, response_body)
+    for every successful line. Missing ids are left to the caller (sync fallback)."""
+    batches = []
+    for chunk in _batch_chunks(bodies):
+        data = build_batch_jsonl(url, chunk)
+        f = with_backoff(lambda: client.files.create(file=("batch_input.jsonl", data), purpose="batch"))
+        b = with_backoff(lambda: client.batches.create(input_file_id=f.id, endpoint=url, completion_window="24h"))
+        print(f"[BATCH] {b.id}: {len(chunk)} requests -> {url}")
+        batches.append(b)
+
+    for b in batches:
+        while b.status not in BATCH_FINAL_STATES:
+            time.sleep(poll_seconds)
+            b = with_backoff(lambda: client.batches.retrieve(b.id))
+        print(f"[BATCH] {b.id}: {b.status}")
+        if not b.output_file_id:
+            continue
+        content = with_backoff(lambda: client.files.content(b.output_file_id)).content
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            rec = orjson.loads(line)
+            resp = rec.get("response") or {}
+            if resp.get("status_code") == 200 and resp.get("body"):
+                on_result(rec["custom_id"], resp["body"])
+
+def enrich_offline_batch(client: OpenAI,
+                         products: List[Dict[str, Any]],
+                         llm_model: str,
+                         embed_model: str,
+                         embed_dim: int,
+                         topk: int,
+                         min_sim: float,
+                         include_embedding: bool,
+                         target_lang: str,
+                         cache: Optional[ExtractionCache] = None,
+                         local_rerank: Optional[str] = None,
+                         skip_short: bool = False) -> List[Optional[Dict[str, Any]]]:
+    """Returns enriched products aligned with `products`; None where the batch gave no usable result."""
+    model = _resolve_llm_model(llm_model)
+    n = len(products)
+    texts = [build_product_text(p) for p in products]
+    keys = [_cache_key(t, model, target_lang) for t in texts]
+    fields: List[Optional[Dict[str, Any]]] = [cache.get(k) for k in keys] if cache is not None else [None] * n
+
+    # 1) LLM extraction (cache hits are not resubmitted, identical texts are submitted once)
+    same_text: Dict[str, List[int]] = {}
+    for i in range(n):
+        if fields[i] is None:
+            same_text.setdefault(keys[i], []).append(i)
+
+    def _on_chat(cid: str, body: Dict[str, Any]):
+        i = int(cid)
+        try:
+            f = _clean_fields(orjson.loads(body["choices"][0]["message"]["content"]))
+        except (KeyError, IndexError, TypeError, ValueError):
+            return
+        for j in same_text[keys[i]]:
+            fields[j] = f
+        if cache is not None:
+            cache.put(keys[i], f)
+
+    chat_bodies = {str(idx[0]): _extraction_body(model, texts[idx[0]], target_lang) for idx in same_text.values()}
+    if chat_bodies:
+        run_openai_batch(client, "/v1/chat/completions", chat_bodies, _on_chat)
+
+    # 2) [base] + candidates embeddings per product, re-scored as lines are read
+    out: List[Optional[Dict[str, Any]]] = [None] * n
+    bases = bases_for_rescore(products)
+
+    def _on_emb(cid: str, body: Dict[str, Any]):
+        i = int(cid)
+        data = sorted(body.get("data") or [], key=lambda d: d["index"])
+        candidates = fields[i]["keyphrases"]
+        if len(data) != len(candidates) + 1:
+            return
+        raw = np.empty((len(data), embed_dim), dtype=np.float32)
+        for j, d in enumerate(data):
+            raw[j] = np.frombuffer(base64.b64decode(d["embedding"]), dtype=np.float32)
+        if cache is not None:
+            texts_i = [bases[i]] + candidates
+            cache.put_vectors({_text_key(embed_model, embed_dim, t): v for t, v in zip(texts_i, raw)})
+        vecs = l2_normalize(raw)
+        keyphrases = rescore_keywords(vecs[:1, :], vecs[1:, :], candidates, topk, min_sim)
+        for j in same_input[i]:
+            out[j] = finalize_enriched(products[j], fields[j], keyphrases, embed_model, embed_dim)
+
+    via_api = {i: needs_api_rescore(fields[i]["keyphrases"], topk, local_rerank, skip_short)
+               for i in range(n) if fields[i] is not None}
+    api_idx = [i for i, api in via_api.items() if api]
+    local_idx = [i for i, api in via_api.items() if not api]
+    for s in range(0, len(local_idx), 128):   # no API calls here: skipped or local re-scoring
+        chunk = local_idx[s:s + 128]
+        items = [{"fields": fields[i], "base": bases[i]} for i in chunk]
+        for i, kws in zip(chunk, rescore_items(client, embed_model, embed_dim, items, topk, min_sim,
+                                               cache, local_rerank, skip_short)):
+            out[i] = finalize_enriched(products[i], fields[i], kws, embed_model, embed_dim)
+
+    by_input: Dict[Tuple[str, ...], List[int]] = {}
+    for i in api_idx:
+        by_input.setdefault((bases[i], *fields[i]["keyphrases"]), []).append(i)
+    same_input = {idx[0]: idx for idx in by_input.values()}
+    emb_bodies = {str(i): {"model": embed_model,
+                           "input": [bases[i]] + fields[i]["keyphrases"],
+                           "dimensions": embed_dim,
+                           "encoding_format": "base64"}
+                  for i in same_input}
+    if emb_bodies:
+        run_openai_batch(client, "/v1/embeddings", emb_bodies, _on_emb)
+
+    # 3) Optional canonical_text embedding (debug/small sets): sync
+    if include_embedding:
+        done = [o for o in out if o is not None]
+        for s in range(0, len(done), EMBED_MAX_INPUTS):
+            add_canonical_embeddings(client, embed_model, embed_dim, done[s:s + EMBED_MAX_INPUTS], cache)
+
+    return out
 
 # -----------------------------
 # Main (parallel)
@@ -340,17 +881,44 @@ def main():
                     help="OpenAI embeddings model")
     ap.add_argument("--embed-dim", type=int, default=int(os.getenv("EMBED_DIM", "1024")),
                     help="Embedding dimensions (supported by model)")
+    ap.add_argument("--llm-batch-size", type=int, default=int(os.getenv("LLM_BATCH_SIZE", "12")),
+                    help="Products extracted per Chat Completion (1 = one call per product, default: 12)")
+    ap.add_argument("--embed-batch-size", type=int, default=int(os.getenv("EMBED_BATCH_SIZE", "128")),
+                    help="Products grouped into a single embeddings request (default: 128)")
     ap.add_argument("--topk", type=int, default=int(os.getenv("TOP_K_KEYWORDS", "16")),
                     help="Max number of keywords after re-scoring")
     ap.add_argument("--min-sim", type=float, default=float(os.getenv("MIN_SIM", "0.25")),
                     help="Cosine similarity threshold to keep a keyword")
+    ap.add_argument("--local-rerank", nargs="?", const="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+                    default=None, metavar="FASTEMBED_MODEL",
+                    help="Re-score keywords with a local fastembed model instead of the embeddings API "
+                         "(default model is multilingual, since product text is not English)")
+    ap.add_argument("--skip-short-rescore", action="store_true",
+                    help="Products with no more candidates than --topk keep the LLM order without embeddings "
+                         "(--min-sim is then NOT applied to them)")
     ap.add_argument("--include-embedding", action="store_true",
                     help="If set, also computes and stores canonical_text embedding (heavier output)")
     ap.add_argument("--pretty", action="store_true", help="Pretty print (only for JSON output)")
     ap.add_argument("--concurrency", type=int, default=int(os.getenv("CONCURRENCY", "50")),
                     help="Number of parallel workers (default: 50)")
+    ap.add_argument("--llm-rpm", type=int, default=int(os.getenv("LLM_RPM", "0")),
+                    help="Max Chat Completions requests per minute (0 = unlimited)")
+    ap.add_argument("--llm-tpm", type=int, default=int(os.getenv("LLM_TPM", "0")),
+                    help="Max Chat Completions tokens per minute, estimated (0 = unlimited)")
+    ap.add_argument("--embed-rpm", type=int, default=int(os.getenv("EMBED_RPM", "0")),
+                    help="Max embeddings requests per minute (0 = unlimited)")
+    ap.add_argument("--embed-tpm", type=int, default=int(os.getenv("EMBED_TPM", "0")),
+                    help="Max embeddings tokens per minute, estimated (0 = unlimited)")
     ap.add_argument("--target-lang", default=os.getenv("TARGET_LANG", "en"),
                     help="Target language for extraction (default: en)")
+    ap.add_argument("--cache-path", default=os.getenv("LLM_CACHE_PATH", "./step2_llm_cache.sqlite"),
+                    help="SQLite file caching LLM extraction results across runs")
+    ap.add_argument("--cache-ttl-days", type=float, default=float(os.getenv("LLM_CACHE_TTL_DAYS", "30")),
+                    help="Ignore cached extractions older than this (0 = never expire, default: 30)")
+    ap.add_argument("--no-cache", action="store_true", help="Disable the on-disk extraction/embedding cache")
+    ap.add_argument("--offline-batch", action="store_true",
+                    help="Submit extraction/embeddings via the OpenAI Batch API (cheaper, up to 24h); "
+                         "products without a batch result go through the sync path")
     args = ap.parse_args()
 
     # Infer formats
@@ -360,61 +928,163 @@ def main():
     else:
         out_is_jsonl = args.out.lower().endswith(".jsonl")
 
-    client = OpenAI()
+    client = make_openai(max(2, args.concurrency * 2))
+    chat_limiter.configure(args.llm_rpm, args.llm_tpm)
+    embed_limiter.configure(args.embed_rpm, args.embed_tpm)
+    cache = None if args.no_cache else ExtractionCache(args.cache_path, args.cache_ttl_days)
 
-    # Read all inputs (for streaming JSONL you could refactor to chunked reading)
+    # Inputs are streamed: at most ~concurrency groups of products are in flight at any time
     reader = read_jsonl if in_is_jsonl else read_json_array
-    products = list(reader(args.inp))
-    n = len(products)
-    print(f"[INFO] Loaded {n} products. Running with concurrency={args.concurrency}")
+    print(f"[INFO] Streaming products from {args.inp}. Running with concurrency={args.concurrency}, "
+          f"llm_batch_size={args.llm_batch_size}, embed_batch_size={args.embed_batch_size}")
 
-    results: List[Optional[Dict[str, Any]]] = [None] * n
+    def _extract(group: List[Any]):
+        prods = [p for _, p in group]
+        try:
+            items = extract_products(client, args.llm_model, prods, args.target_lang, cache=cache)
+        except Exception as e:
+            if len(group) > 1:
+                # one product failed even on its own -> retry per product, only that one gets _error
+                return [res for g in group for res in _extract([g])]
+            return [(idx, None, {**p, "_error": f"{type(e).__name__}: {e}"}) for idx, p in group]
+        out = []
+        for (idx, _), item in zip(group, items):
+            item["idx"] = idx
+            out.append((idx, item, None))
+        return out
 
-    def _task(idx: int, prod: Dict[str, Any]) -> Dict[str, Any]:
+    def _enrich(batch: List[Dict[str, Any]]):
         try:
-            return enrich_product(
+            objs = enrich_batch(
                 client=client,
-                llm_model=args.llm_model,
                 embed_model=args.embed_model,
                 embed_dim=args.embed_dim,
-                prod=prod,
+                extracted=batch,
                 topk=args.topk,
                 min_sim=args.min_sim,
                 include_embedding=args.include_embedding,
-                target_lang=args.target_lang
+                cache=cache,
+                local_rerank=args.local_rerank,
+                skip_short=args.skip_short_rescore
             )
         except Exception as e:
-            return {**prod, "_error": f"{type(e).__name__}: {e}"}
+            if isinstance(e, BadRequestError) and len(batch) > 1:
+                # batch rejected because of one invalid input -> per-product fallback isolates it
+                return [res for it in batch for res in _enrich([it])]
+            objs = [{**it["prod"], "_error": f"{type(e).__name__}: {e}"} for it in batch]
+        return [(it["idx"], obj) for it, obj in zip(batch, objs)]
+
+    completed = 0
+    fw = open(args.out, "wb") if out_is_jsonl else None
+    fa = None if out_is_jsonl else JsonArrayWriter(args.out, pretty=args.pretty)
+    reorder: Dict[int, Dict[str, Any]] = {}   # JSON array keeps input order
+    next_idx = 0
 
-    # Parallel execution
-    with ThreadPoolExecutor(max_workers=args.concurrency) as ex:
-        futures = {ex.submit(_task, i, p): i for i, p in enumerate(products)}
-        completed = 0
-        if out_is_jsonl:
+    def _emit(idx: int, obj: Dict[str, Any]):
+        nonlocal completed, next_idx
+        if fw is not None:
             # Stream to JSONL as they complete (reduced memory)
-            with open(args.out, "w", encoding="utf-8") as fw:
-                for fut in as_completed(futures):
-                    i = futures[fut]
-                    obj = fut.result()
-                    fw.write(json.dumps(obj, ensure_ascii=False) + "\n")
-                    completed += 1
-                    if completed % 50 == 0:
-                        print(f"[PROGRESS] {completed}/{n} done")
+            fw.write(orjson.dumps(obj))
+            fw.write(b"\n")
         else:
-            # Collect then write a JSON array
-            for fut in as_completed(futures):
-                i = futures[fut]
-                results[i] = fut.result()
-                completed += 1
-                if completed % 50 == 0:
-                    print(f"[PROGRESS] {completed}/{n} done")
-
-    # Write JSON array if requested
-    if not out_is_jsonl:
-        arr = [r for r in results if r is not None]
-        write_json_array(args.out, arr, pretty=args.pretty)
-
-    print(f"[DONE] Enriched {n} products -> {args.out}")
+            reorder[idx] = obj
+            while next_idx in reorder:
+                fa.write(reorder.pop(next_idx))
+                next_idx += 1
+        completed += 1
+        if completed % 50 == 0:
+            print(f"[PROGRESS] {completed} done")
+
+    def _drain(futs: List[Any], block: bool) -> List[Any]:
+        still = []
+        for fut in futs:
+            if block or fut.done():
+                for idx, obj in fut.result():
+                    _emit(idx, obj)
+            else:
+                still.append(fut)
+        return still
+
+    def _groups(indexed: Iterable[Any], size: int) -> Iterable[List[Any]]:
+        group: List[Any] = []
+        for item in indexed:
+            group.append(item)
+            if len(group) >= size:
+                yield group
+                group = []
+        if group:
+            yield group
+
+    try:
+        source: Iterable[Any] = enumerate(reader(args.inp))
+        if args.offline_batch:
+            # the Batch API needs the whole request set up front
+            products = list(reader(args.inp))
+            offline: List[Optional[Dict[str, Any]]] = [None] * len(products)
+            try:
+                offline = enrich_offline_batch(
+                    client, products, args.llm_model, args.embed_model, args.embed_dim,
+                    args.topk, args.min_sim, args.include_embedding, args.target_lang, cache=cache,
+                    local_rerank=args.local_rerank, skip_short=args.skip_short_rescore
+                )
+            except Exception as e:
+                print(f"[WARN] Offline batch failed ({type(e).__name__}: {e}); falling back to sync calls")
+            for idx, obj in enumerate(offline):
+                if obj is not None:
+                    _emit(idx, obj)
+            source = ((i, p) for i, p in enumerate(products) if offline[i] is None)
+
+        # Parallel execution: one LLM call per group of products, embeddings per batch of products.
+        # Bounded windows: new groups are read only as earlier ones complete.
+        bs = max(1, args.llm_batch_size)
+        groups = _groups(source, bs)
+        emb_workers = max(1, args.concurrency // 8)
+        max_inflight = max(1, args.concurrency) * 2
+        max_buffered = max_inflight * bs * 4
+        with ThreadPoolExecutor(max_workers=args.concurrency) as ex, \
+             ThreadPoolExecutor(max_workers=emb_workers) as ex_emb:
+            inflight = set()
+            pending: List[Dict[str, Any]] = []
+            emb_futures: List[Any] = []
+
+            def _fill():
+                if inflight and (len(inflight) >= max_inflight or len(reorder) >= max_buffered):
+                    return
+                for g in groups:
+                    inflight.add(ex.submit(_extract, g))
+                    if len(inflight) >= max_inflight:
+                        break
+
+            _fill()
+            while inflight:
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                inflight.difference_update(done)
+                for fut in done:
+                    for idx, item, err in fut.result():
+                        if err is not None:
+                            _emit(idx, err)
+                        else:
+                            pending.append(item)
+                            if len(pending) >= args.embed_batch_size:
+                                emb_futures.append(ex_emb.submit(_enrich, pending))
+                                pending = []
+                emb_futures = _drain(emb_futures, block=False)
+                while len(emb_futures) > emb_workers * 2:
+                    _drain([emb_futures.pop(0)], block=True)
+                _fill()
+            if pending:
+                emb_futures.append(ex_emb.submit(_enrich, pending))
+            _drain(emb_futures, block=True)
+    finally:
+        if fw is not None:
+            fw.close()
+        if fa is not None:
+            fa.close()
+        if cache is not None:
+            cache.close()
+        client.close()
+
+    print(f"[DONE] Enriched {completed} products -> {args.out}")
 
 if __name__ == "__main__":
     main()
@@ -4,10 +4,14 @@
 Step 3: Redis load + vector search (HNSW) with single-product updates
 Keyed by product code (configurable)
 
+Requisiti:
+  pip install openai redis numpy orjson msgpack blake3 "httpx[http2]"
+
 Comandi:
   load   -> carica/aggiorna prodotti arricchiti (Step 2)
   search -> esegue ricerche KNN + filtri
-  delete -> cancella specifici codici dal DB
+  delete -> cancella specifici codici dal DB (o tutto il catalogo con --all)
+  reindex -> ricrea l'indice HNSW (es. da un vecchio indice FLAT) senza cancellare i dati
 
 Esempi:
   # Carica tutto
@@ -21,25 +25,51 @@ Esempi:
     --in ./prodotti_enriched.json \
     --key-field id --keys VCAL250124
 
+  # Gli embedding calcolati restano in cache su Redis (emb:<sha256>, EMB_CACHE_TTL, default 30gg):
+  # ricaricare testi già visti non richiama OpenAI. --force ignora la cache.
+
   # Chiave = upc, forza re-embed
   python step3_redis_load_and_search.py load \
     --in ./prodotti_enriched.json \
     --key-field upc --keys CAL250124 --force
 
+  # Indice quantizzato INT8 (4x meno memoria/banda; Redis 8+; stesso VECTOR_TYPE per l'agente)
+  # oppure FLOAT16 (2x meno memoria, perdita di recall trascurabile)
+  # Su un indice esistente prima: reindex --vector-type INT8 (load rifiuta un indice di tipo diverso)
+  python step3_redis_load_and_search.py load \
+    --in ./prodotti_enriched.json --vector-type INT8
+
   # Ricerca
   python step3_redis_load_and_search.py search \
     --query "gift for cat lovers small wall calendar" --k 10
+  # (embedding delle query in cache qemb:<sha256> condivisa con l'agente: QEMB_TTL, default 1h, 0 = nessuna scadenza)
+
+  # Sessione di ricerca (una query per riga da stdin), connessione OpenAI tenuta calda ogni 30s
+  python step3_redis_load_and_search.py search --k 10 --keepalive 30
 
   # Elimina
   python step3_redis_load_and_search.py delete --keys VCAL250124
+
+  # Svuota il catalogo (SCAN + UNLINK; l'indice resta, la cache emb:* anche)
+  python step3_redis_load_and_search.py delete --all
+
+  # Ricrea l'indice come HNSW (gli HASH vec:* vengono re-indicizzati in background)
+  python step3_redis_load_and_search.py reindex --embed-dim 1024
 """
 
 import os
-import re
 import json
+import base64
 import argparse
+import sys
+import threading
 import hashlib
-from typing import List, Dict, Any, Iterable, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Iterable, Optional, Tuple
+import blake3
+import msgpack
+import orjson
 import numpy as np
 import redis
 
@@ -49,11 +79,16 @@ from redis.commands.search.field import TextField, TagField, NumericField, Vecto
 from redis.commands.search.indexDefinition import IndexDefinition, IndexType
 from redis.commands.search.query import Query
 
+from catalog_common import make_openai, index_vector_info, qemb_key, qemb_store, QEMB_CACHE_SIZE
+
 # ---------- Config di default ----------
 REDIS_URL_DEFAULT = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 INDEX_NAME_DEFAULT = os.getenv("INDEX_NAME", "idx:products")
 JSON_PREFIX = os.getenv("JSON_PREFIX", "prod:")  # JSON per codice prodotto
 VEC_PREFIX  = os.getenv("VEC_PREFIX", "vec:")   # HASH indicizzato + embedding
+HASH_PREFIX = os.getenv("HASH_PREFIX", "hash:") # STRING con il content_hash (prefetch via MGET)
+EMB_CACHE_PREFIX = os.getenv("EMB_CACHE_PREFIX", "emb:")                # cache embedding (float32 bytes)
+EMB_CACHE_TTL    = int(os.getenv("EMB_CACHE_TTL", str(30 * 86400)))    # 0 = nessuna scadenza
 
 # ---------- I/O ----------
 def read_jsonl(path: str) -> Iterable[Dict[str, Any]]:
@@ -61,19 +96,18 @@ def read_jsonl(path: str) -> Iterable[Dict[str, Any]]:
         for line in f:
             line = line.strip()
             if line:
-                yield json.loads(line)
+                yield orjson.loads(line)
 
 def read_json_array(path: str) -> Iterable[Dict[str, Any]]:
-    with open(path, "r", encoding="utf-8") as f:
-        arr = json.load(f)
+    with open(path, "rb") as f:
+        arr = orjson.loads(f.read())
     for o in arr:
         yield o
 
 # ---------- Sanitizzazione per embeddings ----------
 def sanitize_for_embedding(text: Any, max_chars: int) -> str:
     s = "" if text is None else str(text)
-    s = s.replace("\x00", " ")
-    s = re.sub(r"\s+", " ", s).strip()
+    s = " ".join(s.replace("\x00", " ").split())
     if len(s) > max_chars:
         s = s[:max_chars]
     if not s:
@@ -97,38 +131,165 @@ def with_backoff(fn, *, retries: int = 5, base_delay: float = 1.2):
             time.sleep(sleep)
     return fn()
 
+def _decode_embeddings(res: Any, dim: int) -> np.ndarray:
+    # risposta con encoding_format="base64": float32 little-endian, decodificato in una matrice preallocata
+    vecs = np.empty((len(res.data), dim), dtype=np.float32)
+    for i, d in enumerate(res.data):
+        vecs[i] = np.frombuffer(base64.b64decode(d.embedding), dtype=np.float32)
+    return vecs
+
 def embed_batch(client: OpenAI, model: str, dim: int, texts: List[str], *,
                 max_chars: int, codes: Optional[List[str]] = None) -> np.ndarray:
     cleaned = sanitize_batch(texts, max_chars)
 
     def _call():
-        return client.embeddings.create(model=model, input=cleaned, dimensions=dim)
+        return client.embeddings.create(model=model, input=cleaned, dimensions=dim, encoding_format="base64")
 
     try:
-        res = with_backoff(_call)
-        vecs = np.array([d.embedding for d in res.data], dtype=np.float32)
-        return vecs
+        return _decode_embeddings(with_backoff(_call), dim)
     except BadRequestError as e:
         # Batch fallito -> fallback per-item per isolare input sporchi
         out = []
         for i, t in enumerate(cleaned):
             def _one():
-                return client.embeddings.create(model=model, input=[t], dimensions=dim)
+                return client.embeddings.create(model=model, input=[t], dimensions=dim, encoding_format="base64")
             try:
-                r = with_backoff(_one)
-                out.append(np.array(r.data[0].embedding, dtype=np.float32))
+                out.append(_decode_embeddings(with_backoff(_one), dim)[0])
             except BadRequestError as e1:
                 code = codes[i] if (codes and i < len(codes)) else f"idx:{i}"
                 print(f"[WARN] Skipping item due to invalid input for code={code}: {e1}")
                 out.append(np.zeros((dim,), dtype=np.float32))
         return np.vstack(out)
 
-def to_bytes(vec: np.ndarray) -> bytes:
-    return np.asarray(vec, dtype=np.float32).tobytes()
+# ---------- Cache persistente embeddings (Redis emb:<sha256(model|dim|testo)>) ----------
+def _emb_cache_key(model: str, dim: int, text: str) -> str:
+    return EMB_CACHE_PREFIX + hashlib.sha256(f"{model}|{dim}|{text}".encode("utf-8")).hexdigest()
+
+def embed_with_cache(client: OpenAI, r: redis.Redis, model: str, dim: int, texts: List[str], *,
+                     batch_size: int, max_chars: int, codes: Optional[List[str]] = None,
+                     read_cache: bool = True, concurrency: int = 1) -> np.ndarray:
+    """Come embed_batch, ma solo i testi assenti dalla cache Redis (o duplicati) vanno all'API,
+    con fino a `concurrency` batch in volo contemporaneamente."""
+    cleaned = sanitize_batch(texts, max_chars)
+    keys = [_emb_cache_key(model, dim, t) for t in cleaned]
+    out = np.zeros((len(cleaned), dim), dtype=np.float32)
+
+    # varianti con testo identico (colore/taglia): una sola chiave, risultato ridistribuito per indice
+    positions: Dict[str, List[int]] = {}
+    for i, k in enumerate(keys):
+        positions.setdefault(k, []).append(i)
+    uniq = list(positions)
+
+    missing: Dict[str, List[int]] = {}
+    hits = 0
+    for start in range(0, len(uniq), 10000):
+        chunk = uniq[start:start + 10000]
+        vals = r.mget(chunk) if read_cache else [None] * len(chunk)
+        for k, v in zip(chunk, vals):
+            if v is not None and len(v) == dim * 4:
+                out[positions[k]] = np.frombuffer(v, dtype=np.float32)
+                hits += 1
+            else:
+                missing[k] = positions[k]
+    print(f"[LOAD] Embedding cache: {hits} hit, {len(missing)} testi da calcolare "
+          f"({len(keys) - len(uniq)} duplicati)")
+
+    miss_keys = list(missing)
+    chunks = [miss_keys[start:start + batch_size] for start in range(0, len(miss_keys), batch_size)]
+
+    def _embed_chunk(chunk: List[str]) -> np.ndarray:
+        # il fallback per-item su BadRequestError resta dentro embed_batch, per singolo batch
+        first = [missing[k][0] for k in chunk]
+        return embed_batch(client, model, dim, [cleaned[i] for i in first], max_chars=max_chars,
+                           codes=[codes[i] for i in first] if codes else None)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as ex:
+        # map preserva l'ordine; le scritture in cache restano sul thread principale
+        for n_done, (chunk, vecs) in enumerate(zip(chunks, ex.map(_embed_chunk, chunks)), 1):
+            _cache_vectors(r, chunk, vecs, out, missing)
+            if n_done % 10 == 0:
+                print(f"[LOAD] Embedding batch {n_done}/{len(chunks)}…")
+    return out
+
+def _cache_vectors(r: redis.Redis, chunk: List[str], vecs: np.ndarray, out: np.ndarray,
+                   missing: Dict[str, List[int]]):
+    pipe = r.pipeline(transaction=False)
+    for k, v in zip(chunk, vecs):
+        out[missing[k]] = v
+        if not np.any(v):
+            continue  # input scartato (vettore nullo): non va in cache
+        if EMB_CACHE_TTL > 0:
+            pipe.setex(k, EMB_CACHE_TTL, v.astype(np.float32).tobytes())
+        else:
+            pipe.set(k, v.astype(np.float32).tobytes())
+    pipe.execute()
+
+VECTOR_TYPES = ("FLOAT32", "FLOAT16", "INT8")
+
+def quantize_int8(vec: np.ndarray) -> Tuple[bytes, float]:
+    """Quantizzazione simmetrica per-vettore: q = round(v * scale), scale = 127 / max|v|."""
+    v = np.asarray(vec, dtype=np.float32)
+    scale = 127.0 / (float(np.max(np.abs(v))) or 1.0)
+    return np.clip(np.round(v * scale), -128, 127).astype(np.int8).tobytes(), scale
+
+def to_bytes(vec: np.ndarray, vector_type: str = "FLOAT32") -> bytes:
+    v = np.asarray(vec, dtype=np.float32)
+    if vector_type == "INT8":
+        # la distanza COSINE è invariante alla scala: per la ricerca basta il vettore quantizzato
+        return quantize_int8(v)[0]
+    if vector_type == "FLOAT16":
+        return v.astype(np.float16).tobytes()
+    return v.tobytes()
+
+def from_bytes(blob: bytes, vector_type: str, scale: float = 1.0) -> np.ndarray:
+    if vector_type == "INT8":
+        return np.frombuffer(blob, dtype=np.int8).astype(np.float32) / scale
+    if vector_type == "FLOAT16":
+        return np.frombuffer(blob, dtype=np.float16).astype(np.float32)
+    return np.frombuffer(blob, dtype=np.float32)
+
+def convert_vectors(r: redis.Redis, dim: int, vector_type: str) -> int:
+    """Riscrive nel formato `vector_type` gli HASH vec:* salvati con un altro tipo
+    (dedotto dalla lunghezza del blob); ritorna quanti vettori sono stati convertiti."""
+    by_len = {dim * 4: "FLOAT32", dim * 2: "FLOAT16", dim: "INT8"}
+    converted = 0
+    keys: List[bytes] = []
+
+    def _flush():
+        nonlocal converted
+        pipe = r.pipeline(transaction=False)
+        for k in keys:
+            pipe.hmget(k, "embedding", "emb_scale")
+        rows = pipe.execute()
+        pipe = r.pipeline(transaction=False)
+        for k, (blob, scale) in zip(keys, rows):
+            old = by_len.get(len(blob or b""))
+            if old is None or old == vector_type:
+                continue
+            vec = from_bytes(blob, old, float(scale) if scale else 1.0)
+            if vector_type == "INT8":
+                q, new_scale = quantize_int8(vec)
+                pipe.hset(k, mapping={"embedding": q, "emb_scale": repr(new_scale).encode()})
+            else:
+                pipe.hset(k, mapping={"embedding": to_bytes(vec, vector_type)})
+                pipe.hdel(k, "emb_scale")
+            converted += 1
+        pipe.execute()
+        keys.clear()
+
+    for key in r.scan_iter(match=f"{VEC_PREFIX}*", count=1000):
+        keys.append(key)
+        if len(keys) >= 500:
+            _flush()
+    if keys:
+        _flush()
+    return converted
 
 # ---------- Hash di contenuto ----------
-def content_hash(prod: Dict[str, Any], embed_model: str, embed_dim: int) -> str:
-    payload = {
+CONTENT_HASH_ALGO = "blake3-msgpack"   # salvato in content_hash_algo accanto all'hash
+
+def _content_payload(prod: Dict[str, Any], embed_model: str, embed_dim: int) -> Dict[str, Any]:
+    return {
         "canonical_text": prod.get("canonical_text") or "",
         "keywords": prod.get("keywords") or [],
         "topics": prod.get("topics") or [],
@@ -139,15 +300,24 @@ def content_hash(prod: Dict[str, Any], embed_model: str, embed_dim: int) -> str:
         "embed_model": embed_model,
         "embed_dim": embed_dim,
     }
-    s = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+
+def content_hash(prod: Dict[str, Any], embed_model: str, embed_dim: int) -> str:
+    # msgpack con chiavi ordinate = serializzazione canonica; BLAKE3 molto più veloce di JSON + SHA-256
+    payload = dict(sorted(_content_payload(prod, embed_model, embed_dim).items()))
+    return blake3.blake3(msgpack.packb(payload, use_bin_type=True)).hexdigest()
+
+def content_hash_legacy(prod: Dict[str, Any], embed_model: str, embed_dim: int) -> str:
+    """SHA-256 su JSON: solo per confrontare i record scritti prima di content_hash_algo."""
+    s = json.dumps(_content_payload(prod, embed_model, embed_dim), ensure_ascii=False, sort_keys=True)
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
 # ---------- Redis: indice HNSW ----------
-def ensure_index(r: redis.Redis, index_name: str, dim: int):
+def ensure_index(r: redis.Redis, index_name: str, dim: int, vector_type: str = "FLOAT32") -> bool:
+    """Crea l'indice se manca; True se è stato appena creato."""
     ft = r.ft(index_name)
     try:
         ft.info()
-        return
+        return False
     except ResponseError:
         pass
 
@@ -161,7 +331,7 @@ def ensure_index(r: redis.Redis, index_name: str, dim: int):
         NumericField("price"),
         TextField("content_hash"),
         VectorField("embedding", "HNSW", {
-            "TYPE": "FLOAT32",
+            "TYPE": vector_type,
             "DIM": dim,
             "DISTANCE_METRIC": "COSINE",
             "M": 16,
@@ -172,6 +342,7 @@ def ensure_index(r: redis.Redis, index_name: str, dim: int):
         schema,
         definition=IndexDefinition(prefix=[VEC_PREFIX], index_type=IndexType.HASH)
     )
+    return True
 
 # ---------- Load (ingest / upsert) ----------
 def load_products(
@@ -185,7 +356,10 @@ def load_products(
     only_keys: Optional[List[str]],
     skip_unchanged: bool,
     force: bool,
-    max_chars: int
+    max_chars: int,
+    vector_type: str = "FLOAT32",
+    pipeline_batch: int = 1000,
+    embed_concurrency: int = 10
 ):
     in_is_jsonl = inp.lower().endswith(".jsonl")
     reader = read_jsonl if in_is_jsonl else read_json_array
@@ -209,25 +383,47 @@ def load_products(
         print("[LOAD] No products to process. Exit.")
         return
 
-    r = redis.from_url(redis_url, decode_responses=False)
-    ensure_index(r, index_name, embed_dim)
-    client = OpenAI()
+    r = redis.from_url(redis_url, decode_responses=False, socket_keepalive=True)
+    if ensure_index(r, index_name, embed_dim, vector_type):
+        # indice nuovo (es. dopo FT.DROPINDEX a mano): i vec:* già presenti, saltati come invariati,
+        # devono avere il tipo del nuovo indice -> conversione in place, senza ricalcolare embedding
+        n = convert_vectors(r, embed_dim, vector_type)
+        if n:
+            print(f"[LOAD] Converted {n} stored vectors to {vector_type}")
+    current = index_vector_info(r, index_name).get("data_type")
+    if current and current != vector_type:
+        # blob di un tipo diverso da quello dell'indice non vengono indicizzati: la search tornerebbe vuota
+        raise SystemExit(f"[LOAD] L'indice {index_name} è {current}, non {vector_type}: "
+                         f"esegui prima 'reindex --vector-type {vector_type}'")
+    client = make_openai(max(8, embed_concurrency))
 
     # Preleva hash precedente (per skip invariati)
-    prev_hashes: Dict[str, str] = {}
+    prev_hashes: Dict[str, Tuple[str, str]] = {}   # code -> (hash, algoritmo)
+    legacy: List[str] = []                         # codici senza chiave hash:<code>
     if skip_unchanged and not force:
-        pipe = r.pipeline()
-        for p in products:
-            pipe.hget(f"{VEC_PREFIX}{get_code(p)}", "content_hash")
-        res = pipe.execute()
-        for p, val in zip(products, res):
-            code = get_code(p)
-            prev_hashes[code] = val.decode() if isinstance(val, (bytes, bytearray)) else (val or "")
+        codes = [get_code(p) for p in products]
+        for start in range(0, len(codes), 10000):
+            chunk = codes[start:start + 10000]
+            for code, val in zip(chunk, r.mget([f"{HASH_PREFIX}{c}" for c in chunk])):
+                if val is not None:
+                    prev_hashes[code] = (val.decode(), CONTENT_HASH_ALGO)
+                else:
+                    legacy.append(code)
+        if legacy:
+            # record scritti prima delle chiavi hash:<code> -> hash dal campo dell'HASH vec:
+            # (se invariati, la chiave hash: viene creata sotto, così il prossimo load usa solo MGET)
+            pipe = r.pipeline(transaction=False)
+            for code in legacy:
+                pipe.hmget(f"{VEC_PREFIX}{code}", "content_hash", "content_hash_algo")
+            for code, (val, algo) in zip(legacy, pipe.execute()):
+                prev_hashes[code] = ((val or b"").decode(), (algo or b"").decode())
 
     # Decide chi upsertare e quali embedding servono
     to_upsert: List[Dict[str, Any]] = []
     texts_to_embed: List[str] = []
     idx_map: List[int] = []  # indice nel to_upsert
+    backfill: Dict[str, str] = {}  # invariati senza chiave hash:<code>
+    legacy_set = set(legacy)
     for p in products:
         code = get_code(p)
         if not code:
@@ -235,8 +431,14 @@ def load_products(
         chash = content_hash(p, embed_model, embed_dim)
         p["_content_hash_calc"] = chash
 
-        if (skip_unchanged and not force) and prev_hashes.get(code) == chash:
-            continue
+        if skip_unchanged and not force and code in prev_hashes:
+            prev, algo = prev_hashes[code]
+            # record senza content_hash_algo: hash scritto col vecchio SHA-256 su JSON
+            same = prev == (chash if algo == CONTENT_HASH_ALGO else content_hash_legacy(p, embed_model, embed_dim))
+            if prev and same:
+                if code in legacy_set:
+                    backfill[f"{HASH_PREFIX}{code}"] = chash
+                continue
 
         canon = p.get("canonical_text") or ""
         if not canon.strip():
@@ -252,19 +454,23 @@ def load_products(
         to_upsert.append(p)
 
     print(f"[LOAD] To upsert: {len(to_upsert)} (embedding to compute: {len(texts_to_embed)})")
+    items = list(backfill.items())
+    for start in range(0, len(items), 10000):
+        r.mset(dict(items[start:start + 10000]))
 
-    # Calcolo embedding mancanti (batch)
+    # Calcolo embedding mancanti (cache Redis -> batch OpenAI); --force ricalcola tutto
     emb_matrix: List[Optional[np.ndarray]] = [None] * len(to_upsert)
     if texts_to_embed:
-        for start in range(0, len(texts_to_embed), batch_size):
-            chunk = texts_to_embed[start:start+batch_size]
-            chunk_codes = [ (get_code(to_upsert[idx_map[start + j]]) or f"row{idx_map[start+j]+1}") for j in range(len(chunk)) ]
-            vecs = embed_batch(client, embed_model, embed_dim, chunk, max_chars=max_chars, codes=chunk_codes)
-            for j, v in enumerate(vecs):
-                pos = idx_map[start + j]
-                emb_matrix[pos] = v
-
-    # Scrittura su Redis
+        codes = [(get_code(to_upsert[pos]) or f"row{pos+1}") for pos in idx_map]
+        vecs = embed_with_cache(client, r, embed_model, embed_dim, texts_to_embed, batch_size=batch_size,
+                                max_chars=max_chars, codes=codes, read_cache=not force,
+                                concurrency=embed_concurrency)
+        for pos, v in zip(idx_map, vecs):
+            emb_matrix[pos] = v
+
+    # Scrittura su Redis: JSON.SET + HSET nella stessa pipeline non transazionale,
+    # un solo round-trip ogni pipeline_batch prodotti
+    pipeline_batch = max(1, pipeline_batch)
     pipe = r.pipeline(transaction=False)
     for i, p in enumerate(to_upsert, 1):
         code = get_code(p)
@@ -274,7 +480,7 @@ def load_products(
         pj.pop("_content_hash_calc", None)
         if "embedding" in pj:
             pj.pop("embedding", None)
-        r.json().set(f"{JSON_PREFIX}{code}", "$", pj)
+        pipe.execute_command("JSON.SET", f"{JSON_PREFIX}{code}", "$", orjson.dumps(pj))
 
         title = (p.get("title") or "").encode()
         desc  = (p.get("description") or "").encode()
@@ -300,14 +506,21 @@ def load_products(
             "category": category,
             "keywords": kw_tag,
             "content_hash": chash.encode(),
-            "embedding": to_bytes(vec),
+            "content_hash_algo": CONTENT_HASH_ALGO.encode(),
         }
+        if vector_type == "INT8":
+            # scala salvata accanto al vettore: v ≈ q / emb_scale (de-quantizzazione / re-ranking esatto)
+            mapping["embedding"], scale = quantize_int8(vec)
+            mapping["emb_scale"] = repr(scale).encode()
+        else:
+            mapping["embedding"] = to_bytes(vec, vector_type)
         if p.get("price") is not None:
             mapping["price"] = str(float(p["price"])).encode()
 
         pipe.hset(f"{VEC_PREFIX}{code}", mapping=mapping)
+        pipe.set(f"{HASH_PREFIX}{code}", chash)
 
-        if i % 200 == 0:
+        if i % pipeline_batch == 0:
             pipe.execute()
             print(f"[LOAD] Written {i}/{len(to_upsert)}…")
 
@@ -315,14 +528,57 @@ def load_products(
     print(f"[DONE] Upserted {len(to_upsert)} products into Redis (index={index_name})")
 
 # ---------- Search ----------
+_qemb_cache: "OrderedDict[str, bytes]" = OrderedDict()
+
+def start_keepalive(client: OpenAI, model: str, dim: int, interval: float) -> threading.Event:
+    """Embedding minimo (1 carattere, dim <= 256) ogni `interval` secondi: la connessione TLS/HTTP2
+    e l'endpoint embeddings restano caldi tra una query e l'altra (a freddo la prima costa ~1s)."""
+    stop = threading.Event()
+
+    def _loop():
+        while not stop.wait(interval):
+            try:
+                client.embeddings.create(model=model, input=["."], dimensions=min(dim, 256))
+            except Exception:
+                pass
+
+    threading.Thread(target=_loop, name="openai-keepalive", daemon=True).start()
+    return stop
+
+def get_or_embed(client: OpenAI, r: redis.Redis, model: str, dim: int, query_text: str) -> np.ndarray:
+    """Embedding float32 della query: LRU locale -> Redis qemb:<sha256> -> OpenAI."""
+    key = qemb_key(model, dim, query_text)
+
+    raw = _qemb_cache.get(key)
+    if raw is None:
+        raw = r.get(key)
+        if raw is None or len(raw) != dim * 4:
+            def _embed():
+                res = client.embeddings.create(model=model, input=[query_text], dimensions=dim,
+                                               encoding_format="base64")
+                return base64.b64decode(res.data[0].embedding)
+            raw = with_backoff(_embed)
+            qemb_store(r, key, raw)
+    _qemb_cache[key] = raw
+    _qemb_cache.move_to_end(key)
+    while len(_qemb_cache) > QEMB_CACHE_SIZE:
+        _qemb_cache.popitem(last=False)
+    return np.frombuffer(raw, dtype=np.float32)
+
+# Caratteri speciali della query syntax RediSearch da escapare nei filtri TAG
+_TAG_SPECIALS = frozenset(r""" \,.<>{}[]"':;!@#$%^&*()-+=~|/""")
+
+def _escape_tag(s: str) -> str:
+    return "".join("\\" + c if c in _TAG_SPECIALS else c for c in str(s))
+
 def _build_filter(category: Optional[str], brand: Optional[str], must_keywords: Optional[List[str]]) -> str:
     parts = []
     if category:
-        parts.append(f'@category:{{{category}}}')
+        parts.append(f'@category:{{{_escape_tag(category)}}}')
     if brand:
-        parts.append(f'@brand:{{{brand}}}')
+        parts.append(f'@brand:{{{_escape_tag(brand)}}}')
     if must_keywords:
-        safe = [k.replace(" ", "\\ ") for k in must_keywords]
+        safe = [_escape_tag(k) for k in must_keywords]
         parts.append(f'@keywords:{{{"|".join(safe)}}}')
     return " ".join(parts) if parts else "*"
 
@@ -335,30 +591,59 @@ def search_products(
     k: int,
     category: Optional[str],
     brand: Optional[str],
-    must_keywords: Optional[List[str]]
+    must_keywords: Optional[List[str]],
+    vector_type: str = "FLOAT32",
+    ef_runtime: int = 64,
+    keepalive: float = 0
 ):
     r = redis.from_url(redis_url, decode_responses=False)
-    client = OpenAI()
+    client = make_openai()
+    # EF_RUNTIME esiste solo per HNSW: un indice FLAT non ancora migrato con reindex rifiuterebbe la query
+    info = index_vector_info(r, index_name)
+    hnsw = info.get("algorithm") == "HNSW"
+    # il blob della query deve avere il tipo dell'indice, anche se --vector-type dice altro
+    if info.get("data_type") and info["data_type"] != vector_type:
+        print(f"[WARN] Index {index_name} is {info['data_type']}, ignoring --vector-type {vector_type}")
+        vector_type = info["data_type"]
+    args = (embed_model, embed_dim, k, category, brand, must_keywords, vector_type, ef_runtime, hnsw)
+    if query_text:
+        _search_once(client, r, index_name, query_text, *args)
+        return
 
-    def _embed():
-        res = client.embeddings.create(model=embed_model, input=[query_text], dimensions=embed_dim)
-        return np.array(res.data[0].embedding, dtype=np.float32).tobytes()
-    qvec = with_backoff(_embed)
+    # modalità interattiva: una query per riga da stdin, client/Redis/LRU condivisi tra le query
+    if keepalive > 0:
+        start_keepalive(client, embed_model, embed_dim, keepalive)
+    for line in sys.stdin:
+        if line.strip():
+            _search_once(client, r, index_name, line.strip(), *args)
+
+def _search_once(client: OpenAI, r: redis.Redis, index_name: str, query_text: str,
+                 embed_model: str, embed_dim: int, k: int, category: Optional[str], brand: Optional[str],
+                 must_keywords: Optional[List[str]], vector_type: str, ef_runtime: int, hnsw: bool = True):
+    qvec = to_bytes(get_or_embed(client, r, embed_model, embed_dim, query_text), vector_type)
 
     fexpr = _build_filter(category, brand, must_keywords)
+    # con filtri il grafo HNSW scarta parte dei candidati: si esplora di più solo in quel caso
+    ef = max(ef_runtime if fexpr == "*" else 2 * ef_runtime, k)
+    params: Dict[str, Any] = {"vec": qvec, "ef": ef} if hnsw else {"vec": qvec}
     q = (
-        Query(f"({fexpr})=>[KNN {k} @embedding $vec AS score]")
+        Query(f"({fexpr})=>[KNN {k} @embedding $vec{' EF_RUNTIME $ef' if hnsw else ''} AS score]")
         .sort_by("score")
         .paging(0, k)
-        .return_fields("code", "title", "brand", "category", "keywords", "score")
+        .return_fields("code", "score")   # i dettagli arrivano dal JSON, non dall'HASH
         .dialect(2)
     )
-    res = r.ft(index_name).search(q, query_params={"vec": qvec})
+    res = r.ft(index_name).search(q, query_params=params)
+
+    codes = [d.code.decode() if isinstance(d.code, (bytes, bytearray)) else str(d.code) for d in res.docs]
+    pipe = r.pipeline(transaction=False)
+    for code in codes:
+        pipe.execute_command("JSON.GET", f"{JSON_PREFIX}{code}")
+    raws = pipe.execute() if codes else []
 
     out = []
-    for d in res.docs:
-        code = d.code.decode() if isinstance(d.code, (bytes, bytearray)) else str(d.code)
-        j = r.json().get(f"{JSON_PREFIX}{code}") or {}
+    for d, code, raw in zip(res.docs, codes, raws):
+        j = orjson.loads(raw) if raw else {}
         out.append({
             "code": code,
             "title": j.get("title"),
@@ -371,16 +656,52 @@ def search_products(
 
     print(json.dumps(out, ensure_ascii=False, indent=2))
 
+# ---------- Reindex ----------
+def reindex(redis_url: str, index_name: str, embed_dim: int, vector_type: str = "FLOAT32"):
+    r = redis.from_url(redis_url, decode_responses=False)
+    try:
+        r.ft(index_name).dropindex(delete_documents=False)
+        print(f"[REINDEX] Dropped index {index_name} (documents kept)")
+    except ResponseError:
+        pass
+    # i blob devono avere il tipo del nuovo indice, altrimenti non vengono indicizzati
+    n = convert_vectors(r, embed_dim, vector_type)
+    if n:
+        print(f"[REINDEX] Converted {n} vectors to {vector_type}")
+    ensure_index(r, index_name, embed_dim, vector_type)
+    print(f"[REINDEX] Created HNSW index {index_name}; existing {VEC_PREFIX}* hashes are re-indexed in background")
+
 # ---------- Delete ----------
+DELETE_CHUNK = 500   # comandi UNLINK per round-trip
+
 def delete_products(redis_url: str, keys: List[str]):
+    # UNLINK: la memoria dei JSON grandi viene liberata in background, Redis non si blocca
     r = redis.from_url(redis_url, decode_responses=False)
-    pipe = r.pipeline()
-    for code in keys:
-        pipe.delete(f"{JSON_PREFIX}{code}")
-        pipe.delete(f"{VEC_PREFIX}{code}")
-    pipe.execute()
+    for start in range(0, len(keys), DELETE_CHUNK):
+        pipe = r.pipeline(transaction=False)
+        for code in keys[start:start + DELETE_CHUNK]:
+            pipe.unlink(f"{JSON_PREFIX}{code}", f"{VEC_PREFIX}{code}", f"{HASH_PREFIX}{code}")
+        pipe.execute()
     print(f"[DELETE] Removed {len(keys)} codes.")
 
+def delete_all(r: redis.Redis, prefix: str) -> int:
+    """UNLINK di tutte le chiavi `prefix*` via SCAN (non blocca come KEYS), a blocchi di DELETE_CHUNK."""
+    n = 0
+    batch: List[bytes] = []
+    for key in r.scan_iter(match=f"{prefix}*", count=1000):
+        batch.append(key)
+        if len(batch) >= DELETE_CHUNK:
+            n += r.unlink(*batch)
+            batch = []
+    if batch:
+        n += r.unlink(*batch)
+    return n
+
+def wipe_catalog(redis_url: str):
+    r = redis.from_url(redis_url, decode_responses=False)
+    for prefix in (JSON_PREFIX, VEC_PREFIX, HASH_PREFIX):
+        print(f"[DELETE] {prefix}*: removed {delete_all(r, prefix)} keys")
+
 # ---------- CLI ----------
 def main():
     ap = argparse.ArgumentParser(description="Step 3: Redis load + vector search (keyed by product code)")
@@ -400,9 +721,18 @@ def main():
     ap_load.add_argument("--force", action="store_true", help="Ignora content_hash e sovrascrivi")
     ap_load.add_argument("--max-chars", type=int, default=int(os.getenv("MAX_CHARS", "12000")),
                          help="Max caratteri per l'input embedding (default: 12000)")
+    ap_load.add_argument("--pipeline-batch", type=int, default=int(os.getenv("PIPELINE_BATCH", "1000")),
+                         help="Prodotti scritti per round-trip Redis (default: 1000)")
+    ap_load.add_argument("--embed-concurrency", type=int, default=int(os.getenv("EMBED_CONCURRENCY", "10")),
+                         help="Batch di embedding in parallelo verso OpenAI (default: 10)")
+    ap_load.add_argument("--vector-type", choices=VECTOR_TYPES, default=os.getenv("VECTOR_TYPE", "FLOAT32").upper(),
+                         help="Tipo vettore dell'indice: FLOAT32, FLOAT16 (2x meno memoria) o INT8 quantizzato "
+                              "(4x meno memoria, Redis 8+). "
+                              "Per cambiarlo: 'reindex --vector-type X' (converte in place i vettori salvati), "
+                              "poi load con lo stesso tipo")
 
     ap_search = sub.add_parser("search", help="Semantic search via Redis")
-    ap_search.add_argument("--query", required=True)
+    ap_search.add_argument("--query", help="Query; se omessa legge una query per riga da stdin (sessione interattiva)")
     ap_search.add_argument("--k", type=int, default=10)
     ap_search.add_argument("--redis-url", default=REDIS_URL_DEFAULT)
     ap_search.add_argument("--index-name", default=INDEX_NAME_DEFAULT)
@@ -411,10 +741,28 @@ def main():
     ap_search.add_argument("--category")
     ap_search.add_argument("--brand")
     ap_search.add_argument("--kw", nargs="*", help="List of required keywords (Tag OR)")
-
-    ap_delete = sub.add_parser("delete", help="Delete products by code")
+    ap_search.add_argument("--vector-type", choices=VECTOR_TYPES, default=os.getenv("VECTOR_TYPE", "FLOAT32").upper(),
+                           help="Tipo vettore dell'indice (deve combaciare con quello usato in load)")
+    ap_search.add_argument("--ef-runtime", type=int, default=int(os.getenv("EF_RUNTIME", "64")),
+                           help="HNSW EF_RUNTIME: candidati esplorati per query, raddoppiati se ci sono filtri "
+                                "(più alto = recall maggiore, default: 64)")
+    ap_search.add_argument("--keepalive", type=float, default=float(os.getenv("OPENAI_KEEPALIVE", "0")),
+                           help="Solo senza --query: embedding minimo ogni N secondi per tenere calda la "
+                                "connessione OpenAI tra le query (es. 30; 0 = off)")
+
+    ap_reindex = sub.add_parser("reindex", help="Drop and recreate the HNSW index (documents are kept, "
+                                                "stored vectors are converted to --vector-type)")
+    ap_reindex.add_argument("--redis-url", default=REDIS_URL_DEFAULT)
+    ap_reindex.add_argument("--index-name", default=INDEX_NAME_DEFAULT)
+    ap_reindex.add_argument("--embed-dim", type=int, default=int(os.getenv("EMBED_DIM", "1024")))
+    ap_reindex.add_argument("--vector-type", choices=VECTOR_TYPES, default=os.getenv("VECTOR_TYPE", "FLOAT32").upper())
+
+    ap_delete = sub.add_parser("delete", help="Delete products by code (or the whole catalog)")
     ap_delete.add_argument("--redis-url", default=REDIS_URL_DEFAULT)
-    ap_delete.add_argument("--keys", nargs="+", required=True, help="Codes to delete")
+    what = ap_delete.add_mutually_exclusive_group(required=True)
+    what.add_argument("--keys", nargs="+", help="Codes to delete")
+    what.add_argument("--all", action="store_true",
+                      help="Cancella tutti i prodotti (prod:*, vec:*, hash:*); indice e cache embedding restano")
 
     args = ap.parse_args()
 
@@ -430,7 +778,10 @@ def main():
             only_keys=args.keys,
             skip_unchanged=args.skip_unchanged and (not args.force),
             force=args.force,
-            max_chars=args.max_chars
+            max_chars=args.max_chars,
+            vector_type=args.vector_type,
+            pipeline_batch=args.pipeline_batch,
+            embed_concurrency=args.embed_concurrency
         )
     elif args.cmd == "search":
         search_products(
@@ -442,8 +793,20 @@ def main():
             k=args.k,
             category=args.category,
             brand=args.brand,
-            must_keywords=args.kw
+            must_keywords=args.kw,
+            vector_type=args.vector_type,
+            ef_runtime=args.ef_runtime,
+            keepalive=args.keepalive
+        )
+    elif args.cmd == "reindex":
+        reindex(
+            redis_url=args.redis_url,
+            index_name=args.index_name,
+            embed_dim=args.embed_dim,
+            vector_type=args.vector_type
         )
+    elif args.cmd == "delete" and args.all:
+        wipe_catalog(redis_url=args.redis_url)
     elif args.cmd == "delete":
         delete_products(
             redis_url=args.redis_url,
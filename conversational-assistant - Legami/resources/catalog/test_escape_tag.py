@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test dell'escape dei valori TAG nei filtri RediSearch (Step 3 search e gift finder agent).
+
+Esecuzione:
+  python -m pytest -q test_escape_tag.py
+"""
+
+import pytest
+
+import gift_finder_agent
+from step3_redis_load_and_search import _build_filter, _escape_tag
+
+@pytest.mark.parametrize("value, expected", [
+    ("Agende", "Agende"),
+    ("Cat Lover", r"Cat\ Lover"),
+    ("back-to-school", r"back\-to\-school"),
+    ("a|b", r"a\|b"),
+    ("{x}", r"\{x\}"),
+    ("Legami, Milano.", r"Legami\,\ Milano\."),
+    ("50% off!", r"50\%\ off\!"),
+    ("l'amore @casa", r"l\'amore\ \@casa"),
+    ("Più bello", r"Più\ bello"),
+    (123, "123"),
+])
+def test_escape_tag(value, expected):
+    assert _escape_tag(value) == expected
+    # l'agente costruisce gli stessi filtri: l'escape deve coincidere
+    assert gift_finder_agent._escape_tag(value) == expected
+
+def test_build_filter_without_filters():
+    assert _build_filter(None, None, None) == "*"
+    assert _build_filter("", "", []) == "*"
+
+def test_build_filter_escapes_every_value():
+    fexpr = _build_filter("Wall Calendar", "Legami-Milano", ["cat lover", "a|b", "{gift}"])
+    assert fexpr == (
+        r"@category:{Wall\ Calendar} "
+        r"@brand:{Legami\-Milano} "
+        r"@keywords:{cat\ lover|a\|b|\{gift\}}"
+    )